@@ -0,0 +1,177 @@
+"""Benchmarks of the checksum code
+
+Datasets are either given on the command line or synthetic: a directory of
+random, incompressible files named like raw data.  Results are plain dicts so
+they can be saved as JSON and compared between versions.  The same checksum
+paths can be timed with pytest-benchmark, see tests/test_benchmark.py.
+"""
+
+import datetime
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import checksumdir
+
+from cax import __version__, config
+from cax.tasks import checksum
+
+# Read block sizes tried by bench_digests
+BLOCKSIZES = (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024,
+              16 * 1024 * 1024)
+
+
+def make_dataset(path, n_files=8, file_size=64 * 1024 * 1024):
+    """Fill path with n_files random files of file_size bytes"""
+    os.makedirs(path, exist_ok=True)
+    chunk = 1024 * 1024
+    for i in range(n_files):
+        name = 'XENON1T-0-%09d-%09d-000001000.zip' % (i * 1000, i * 1000 + 999)
+        with open(os.path.join(path, name), 'wb') as f:
+            left = file_size
+            while left > 0:
+                f.write(os.urandom(min(chunk, left)))
+                left -= chunk
+    return path
+
+
+def dataset_size(location):
+    """Total bytes of the files of a dataset"""
+    return sum(os.path.getsize(f) for f in checksum.dataset_files(location))
+
+
+def timed(function, *args, repeat=3, **kwargs):
+    """Returns the result of function and its best wall time in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def checksum_paths():
+    """Returns the ways cax checksums data, by name
+
+    Each takes the location of a dataset.
+    """
+    methods = checksum.ChecksumMethods()
+
+    def each_file(function):
+        return lambda location: [function(f) for f in
+                                 checksum.dataset_files(location)]
+
+    paths = {'dirhash sha512': lambda location: checksum.dirhash(location,
+                                                                  'sha512'),
+             'ChecksumMethods.get_adler32': each_file(methods.get_adler32),
+             'ChecksumMethods.get_crc32': each_file(methods.get_crc32),
+             'config.get_adler32': each_file(config.get_adler32)}
+
+    # Needs the transfer dependencies
+    try:
+        from cax.tasks.tsm_mover import TSMclient
+    except ImportError:
+        pass
+    else:
+        paths['TSMclient.get_checksum_folder'] = \
+            TSMclient().get_checksum_folder
+
+    return paths
+
+
+def bench_paths(location, repeat=3):
+    """Time every checksum path on a dataset"""
+    size = dataset_size(location)
+
+    results = []
+    for name, function in sorted(checksum_paths().items()):
+        result, seconds = timed(function, location, repeat=repeat)
+        results.append({'name': name,
+                        'seconds': seconds,
+                        'mb_per_s': size / seconds / 1e6})
+    return results
+
+
+def bench_dirhash(location, workers=(1, 2, 4, 8), repeat=3):
+    """Compare checksumdir.dirhash to the parallel dirhash"""
+    size = dataset_size(location)
+
+    serial, serial_time = timed(checksumdir.dirhash, location, 'sha512',
+                                repeat=repeat)
+    results = [{'name': 'checksumdir.dirhash',
+                'workers': 1,
+                'seconds': serial_time,
+                'mb_per_s': size / serial_time / 1e6}]
+
+    for n in workers:
+        value, seconds = timed(checksum.dirhash, location, 'sha512',
+                               workers=n, repeat=repeat)
+        if value != serial:
+            raise RuntimeError("dirhash with %d workers differs from "
+                               "checksumdir.dirhash" % n)
+        results.append({'name': 'dirhash',
+                        'workers': n,
+                        'seconds': seconds,
+                        'mb_per_s': size / seconds / 1e6,
+                        'speedup': serial_time / seconds})
+    return results
+
+
+def bench_digests(path, blocksizes=BLOCKSIZES, repeat=3):
+    """Throughput of each algorithm, and of all at once, per block size
+
+    The file is read once beforehand, so this measures hashing from the page
+    cache rather than the disk.
+    """
+    size = os.path.getsize(path)
+    checksum.compute_digests(path, checksum.ALGORITHMS)
+
+    results = []
+    for blocksize in blocksizes:
+        for algorithms in [(a,) for a in checksum.ALGORITHMS] + \
+                [checksum.ALGORITHMS]:
+            digests, seconds = timed(checksum.compute_digests, path,
+                                     algorithms, blocksize, repeat=repeat)
+            results.append({'algorithms': '+'.join(algorithms),
+                            'blocksize': blocksize,
+                            'seconds': seconds,
+                            'mb_per_s': size / seconds / 1e6})
+    return results
+
+
+def metadata():
+    """Where and with what the benchmarks ran"""
+    return {'time': datetime.datetime.utcnow().isoformat(),
+            'host': config.get_hostname(),
+            'cax': __version__,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            # Repeated runs are served from it, if any
+            'checksum_cache': config.get_checksum_cache()}
+
+
+def run(location=None, n_files=8, file_size=64 * 1024 * 1024,
+        workers=(1, 2, 4, 8), repeat=3, blocksizes=BLOCKSIZES):
+    """Run the benchmarks, on a synthetic dataset if no location is given"""
+    tmp_dir = None
+    if location is None:
+        tmp_dir = tempfile.mkdtemp(prefix='cax_benchmark_')
+        location = make_dataset(os.path.join(tmp_dir, 'dataset'),
+                                n_files, file_size)
+
+    try:
+        largest = max(checksum.dataset_files(location), key=os.path.getsize)
+        return {'meta': metadata(),
+                'location': location,
+                'files': len(checksum.dataset_files(location)),
+                'bytes': dataset_size(location),
+                'paths': bench_paths(location, repeat),
+                'dirhash': bench_dirhash(location, workers, repeat),
+                'digests': bench_digests(largest, blocksizes, repeat)}
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
@@ -8,7 +8,7 @@ import logging
 import os
 import pax
 import socket
-from zlib import adler32
+import threading
 import pymongo
 
 # global variable to store the specified .json config file
@@ -31,6 +31,33 @@ PAX_DEPLOY_DIRS = {
 
 RUCIO_RULE = ''
 
+# Default MongoClient options, can be overridden per host with 'mongo' in
+# cax.json.  Every task shares the same client, so a modest pool suffices.
+MONGO_OPTIONS = {'maxPoolSize': 20,
+                 'connectTimeoutMS': 30000,
+                 'serverSelectionTimeoutMS': 60000}
+
+# Default concurrency of CopyPush/CopyPull transfers, can be overridden per
+# host with 'transfer_slots' in cax.json.  See cax.transfer.TransferScheduler.
+TRANSFER_SLOTS = {'max_transfers': 1,
+                  'per_destination': 1,
+                  'per_link': 1}
+
+# Default settings of per file SCP transfers, can be overridden per host with
+# 'sftp' in cax.json.  See cax.transfer.SFTPCopy.
+SFTP_OPTIONS = {'workers': 4,
+                'connections': 1,
+                'retries': 3}
+
+# MongoClients shared within this process, see mongo_client()
+_MONGO_CLIENTS = {}
+_MONGO_PID = None
+_MONGO_LOCK = threading.Lock()
+
+# Parsed cax.json indexed by host name, see get_hosts()
+_CONFIG_CACHE = {'key': None, 'hosts': None}
+_CONFIG_LOCK = threading.Lock()
+
 # URI for the mongo runs database
 RUNDB_URI = 'mongodb://eb:%s@xenon1t-daq.lngs.infn.it:27017,copslx50.fysik.su.se:27017,zenigata.uchicago.edu:27017/run'
 
@@ -71,21 +98,47 @@ def set_database_log(config):
     global DATABASE_LOG
     DATABASE_LOG = config
 
-def load():
+def config_filename():
     # User-specified config file
     if CAX_CONFIGURE:
-        filename = os.path.abspath(CAX_CONFIGURE)
+        return os.path.abspath(CAX_CONFIGURE)
 
     # Default config file
-    else:
-        dirname = os.path.dirname(os.path.abspath(__file__))
-        filename = os.path.join(dirname, 'cax.json')
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(dirname, 'cax.json')
+
+
+def load():
+    filename = config_filename()
 
     logging.debug('Loading config file %s' % filename)
 
     return json.loads(open(filename, 'r').read())
 
 
+def get_hosts():
+    """Returns the cax.json configurations indexed by hostname
+
+    The file is only parsed again when its path, size or modification time
+    changed, so this is cheap enough to call from within loops.
+    """
+    filename = config_filename()
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+
+    with _CONFIG_LOCK:
+        if _CONFIG_CACHE['key'] != key:
+            hosts = {}
+            for doc in load():
+                # First entry wins, as when scanning the list
+                hosts.setdefault(doc['name'], doc)
+
+            _CONFIG_CACHE['key'] = key
+            _CONFIG_CACHE['hosts'] = hosts
+
+        return _CONFIG_CACHE['hosts']
+
+
 def purge_version(hostname=get_hostname()):
     """
     You can select which pax version you want purge
@@ -110,13 +163,15 @@ def get_cert(hostname=get_hostname()):
 
 def get_config(hostname=get_hostname()):
     """Returns the cax configuration for a particular hostname
-    NB this currently reloads the cax.json file every time it is called!!
+
+    The cax.json file is cached and reloaded when modified, see get_hosts().
+    Do not modify the returned configuration.
     """
-    for doc in load():
-        if doc['name'] == hostname:
-            return doc
-        elif hostname == "upload_tsm":
-            return hostname
+    hosts = get_hosts()
+    if hostname in hosts:
+        return hosts[hostname]
+    elif hostname == "upload_tsm":
+        return hostname
     raise LookupError("Unknown host %s" % hostname)
 
 
@@ -144,7 +199,7 @@ def get_transfer_options(transfer_kind='upload', transfer_method=None):
 def get_pax_options(option_type='versions'):
     try:
         options = get_config(get_hostname())['pax_%s' % option_type]
-    except LookupError as e:
+    except LookupError:
         logging.info("Pax versions not specified: %s", get_hostname())
         return []
 
@@ -154,33 +209,199 @@ def get_pax_options(option_type='versions'):
 def get_dataset_list():
     try:
         options = get_config(get_hostname())['dataset_list']
-    except LookupError as e:
+    except LookupError:
         logging.debug("dataset_list not specified, operating on entire DB")
         return []
 
     return options
 
 
+def get_batch_size():
+    """Number of run documents fetched per query, None for task default"""
+    try:
+        options = get_config(get_hostname())['batch_size']
+    except LookupError:
+        logging.debug("batch_size not specified, using task default")
+        return None
+
+    return options
+
+
+def get_workers(task_name):
+    """Number of runs a task handles concurrently, None for task default"""
+    try:
+        options = get_config(get_hostname())['workers']
+    except LookupError:
+        logging.debug("workers not specified, using task default")
+        return None
+
+    return options.get(task_name)
+
+
+def get_checksum_workers():
+    """Number of files hashed concurrently, None for the default"""
+    try:
+        options = get_config(get_hostname())['checksum_workers']
+    except LookupError:
+        logging.debug("checksum_workers not specified, using default")
+        return None
+
+    return options
+
+
+def get_checksum_cache():
+    """SQLite file keeping per-file checksums, None to not keep them"""
+    try:
+        options = get_config(get_hostname())['checksum_cache']
+    except LookupError:
+        logging.debug("checksum_cache not specified, not caching checksums")
+        return None
+
+    return os.path.expanduser(options)
+
+
+def get_checksum_blocksize():
+    """Bytes read at once when checksumming, None for the default"""
+    try:
+        options = get_config(get_hostname())['checksum_blocksize']
+    except LookupError:
+        logging.debug("checksum_blocksize not specified, using default")
+        return None
+
+    return options
+
+
+def get_checksum_audit():
+    """Settings of AuditChecksums, None if not auditing on this host"""
+    try:
+        options = get_config(get_hostname())['checksum_audit']
+    except LookupError:
+        logging.debug("checksum_audit not specified, not auditing")
+        return None
+
+    return options
+
+
+def get_checksum_offload():
+    """Settings to checksum large datasets in batch jobs, None to not"""
+    try:
+        options = get_config(get_hostname())['checksum_offload']
+    except LookupError:
+        logging.debug("checksum_offload not specified, checksumming here")
+        return None
+
+    return options
+
+
+def get_transfer_slots():
+    """How many transfers may run at once, in total, per destination and
+    per link"""
+    slots = dict(TRANSFER_SLOTS)
+    try:
+        slots.update(get_config(get_hostname())['transfer_slots'])
+    except LookupError:
+        logging.debug("transfer_slots not specified, one transfer at a time")
+
+    return slots
+
+
+def get_sftp_options():
+    """Files copied at once, SSH connections used and retries per file"""
+    options = dict(SFTP_OPTIONS)
+    try:
+        options.update(get_config(get_hostname())['sftp'])
+    except LookupError:
+        logging.debug("sftp not specified, using default transfer options")
+
+    return options
+
+
+def get_stall_timeout():
+    """Seconds rsync may print nothing before it is killed as stalled"""
+    try:
+        options = get_config(get_hostname())['stall_timeout']
+    except LookupError:
+        logging.debug("stall_timeout not specified, using default")
+        return None
+
+    return options
+
+
+def get_ssh_compress(remote_host):
+    """Whether SSH to remote_host is compressed
+
+    'ssh_compress' in cax.json is either true or false for all links from this
+    host, or maps remote host names to true or false.  Compression costs more
+    CPU than it saves on fast links.
+    """
+    try:
+        compress = get_config(get_hostname())['ssh_compress']
+    except LookupError:
+        logging.debug("ssh_compress not specified, compressing")
+        return True
+
+    if isinstance(compress, dict):
+        return compress.get(remote_host, True)
+    return compress
+
+
 def get_task_list():
     try:
         options = get_config(get_hostname())['task_list']
-    except LookupError as e:
+    except LookupError:
         logging.debug("task_list not specified, running all tasks")
         return []
 
     return options
 
+def mongo_settings():
+    """MongoClient options for this host"""
+    options = dict(MONGO_OPTIONS)
+    try:
+        options.update(get_config(get_hostname())['mongo'])
+    except LookupError:
+        logging.debug("mongo not specified, using default client options")
+
+    return options
+
+
+def mongo_client(uri, **kwargs):
+    """Returns the MongoClient shared within this process for this URI
+
+    Keyword arguments are passed to MongoClient on top of mongo_settings().
+    Clients are not fork safe, so a forked child makes its own.
+    """
+    global _MONGO_PID
+
+    options = mongo_settings()
+    options.update(kwargs)
+    key = (uri, tuple(sorted(options.items())))
+
+    with _MONGO_LOCK:
+        if _MONGO_PID != os.getpid():
+            # Inherited from the parent, leave those alone
+            _MONGO_CLIENTS.clear()
+            _MONGO_PID = os.getpid()
+
+        if key not in _MONGO_CLIENTS:
+            logging.debug("New MongoDB client for %s" % uri.split('@')[-1])
+            _MONGO_CLIENTS[key] = pymongo.MongoClient(uri, **options)
+
+        return _MONGO_CLIENTS[key]
+
+
 def mongo_collection(collection_name='runs_new'):
     # For the event builder to communicate with the gateway, we need to use the DAQ network address
     # Otherwise, use the internet to find the runs database
     if get_hostname().startswith('eb'):
-        c = pymongo.MongoClient('mongodb://eb:%s@gw:27017/run' % os.environ.get('MONGO_PASSWORD'))
+        c = mongo_client('mongodb://eb:%s@gw:27017/run' % os.environ.get('MONGO_PASSWORD'))
     else:
         uri = RUNDB_URI
         uri = uri % os.environ.get('MONGO_PASSWORD')
-        c = pymongo.MongoClient(uri,
-                                replicaSet='runs',
-                                readPreference='secondaryPreferred')
+        options = {'replicaSet': 'runs',
+                   'readPreference': 'secondaryPreferred'}
+        options.update(mongo_settings())
+        c = mongo_client(uri, **options)
     db = c['run']
     collection = db[collection_name]
     return collection
@@ -317,19 +538,10 @@ def get_adler32( fname ):
   """Calcualte an Adler32 checksum in python
      Used for cross checks with Rucio
   """
-  
-  BLOCKSIZE=256*1024*1024
-  asum = 1
-  with open(fname, "rb") as f:
-    while True:
-      data = f.read(BLOCKSIZE)
-      if not data:
-        break
-      asum = adler32(data, asum)
-      if asum < 0:
-        asum += 2**32
-
-  return hex(asum)[2:10].zfill(8).lower()
+  # cax.tasks imports this module
+  from cax.tasks.checksum import file_digest
+
+  return file_digest(fname, 'adler32')
 
 #Rucio stuff:
 def set_rucio_rse( rucio_rse):
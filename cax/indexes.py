@@ -0,0 +1,117 @@
+"""Indexes of the runs collection
+
+cax queries the runs collection on a few fields only: run number and name,
+start and end time, tags, detector and the host, type, status and pax version
+of data entries.  This lists the indexes serving those queries, checks which of them
+are missing on the live collection and creates them.
+"""
+
+import logging
+
+# Indexes cax relies on, with what uses them
+INDEXES = [
+    ([('start', -1)], "Task.go sort, massive-cax time window"),
+    ([('number', 1)], "--run, massive-cax --start/--stop"),
+    ([('name', 1), ('detector', 1)], "--name, dataset_list, cax-process"),
+    ([('tags.name', 1), ('start', -1)], "massive-cax --tag"),
+    ([('detector', 1), ('start', -1)], "data_availability"),
+    ([('end', -1)], "correction run filters"),
+    ([('data.host', 1), ('data.status', 1)], "task run filters"),
+    ([('data.host', 1), ('data.type', 1), ('data.pax_version', 1)],
+     "processing and purge run filters, cax-process"),
+]
+
+# Representative queries cax issues, see Task.run_filter for the others
+QUERY_SHAPES = {
+    'Task.go --run': {'number': 1},
+    'Task.go --name': {'name': 'run_name'},
+    'dataset_list': {'name': {'$in': ['run_name']}},
+    'massive-cax': {'start': {'$gt': 'time'},
+                    'number': {'$gte': 1},
+                    'tags.name': 'tag'},
+    'massive-cax --tag': {'tags.name': 'tag'},
+    'data_availability': {'detector': 'tpc'},
+    'cax-process': {'name': 'run_name',
+                    'detector': 'tpc',
+                    'data': {'$elemMatch': {'host': 'host',
+                                            'type': 'processed',
+                                            'pax_version': 'version'}}},
+    'mover status update': {'data': {'$elemMatch': {'host': 'host',
+                                                    'type': 'raw',
+                                                    'status': 'transferring'}}},
+}
+
+
+def query_fields(query, prefix=''):
+    """Returns the dotted field paths a query filters on"""
+    fields = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for clause in value:
+                fields |= query_fields(clause, prefix)
+        elif key == '$elemMatch':
+            fields |= query_fields(value, prefix)
+        elif key.startswith('$'):
+            continue
+        else:
+            path = prefix + key
+            fields.add(path)
+            if isinstance(value, dict):
+                fields |= query_fields(value, path + '.')
+    return fields
+
+
+def serving_index(query, indexes=None):
+    """Returns the keys of the first index usable by the query, if any
+
+    An index is usable if the query filters on its leading field.  A $or
+    needs one for each of its clauses, else it is a collection scan.
+    """
+    if indexes is None:
+        indexes = [keys for keys, reason in INDEXES]
+
+    fields = query_fields({key: value for key, value in query.items()
+                           if key not in ('$and', '$or', '$nor')})
+    for keys in indexes:
+        if keys[0][0] in fields:
+            return keys
+
+    for clause in query.get('$and', []):
+        keys = serving_index(clause, indexes)
+        if keys is not None:
+            return keys
+
+    if '$or' in query:
+        served = [serving_index(clause, indexes) for clause in query['$or']]
+        if all(keys is not None for keys in served):
+            return served[0]
+    return None
+
+
+def live_indexes(collection):
+    """Returns the keys of the indexes on the collection"""
+    return [[tuple(key) for key in info['key']]
+            for info in collection.index_information().values()]
+
+
+def missing_indexes(collection):
+    """Returns the INDEXES not yet on the collection
+
+    An existing index with the same leading keys is good enough.
+    """
+    existing = live_indexes(collection)
+
+    missing = []
+    for keys, reason in INDEXES:
+        if not any(index[:len(keys)] == keys for index in existing):
+            missing.append((keys, reason))
+    return missing
+
+
+def create_indexes(collection):
+    """Create the missing indexes, returns their names"""
+    names = []
+    for keys, reason in missing_indexes(collection):
+        logging.info("Creating index %s for %s" % (keys, reason))
+        names.append(collection.create_index(keys, background=True))
+    return names
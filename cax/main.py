@@ -1,4 +1,5 @@
 import argparse
+import json
 import logging
 import os
 import datetime
@@ -6,7 +7,7 @@ import time
 import subprocess
 
 from cax import __version__
-from cax import config, qsub
+from cax import config, qsub, sweep, indexes, benchmark, transfer
 
 import pax
 
@@ -40,6 +41,18 @@ def main():
                         help="Host to pretend to be")
     parser.add_argument('--ncpu', type=int, default=1,
                         help="Number of CPU per job")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only visit runs changed since the last sweep, "
+                             "with a periodic full sweep")
+    parser.add_argument('--full-sweep', dest='full_sweep', type=float,
+                        default=6,
+                        help="Hours between full sweeps in incremental mode")
+    parser.add_argument('--state-file', dest='state_file', type=str,
+                        default='cax_sweep.json',
+                        help="File keeping track of the last sweep")
+    parser.add_argument('--single-pass', dest='single_pass',
+                        action='store_true',
+                        help="Read each run once and hand it to all tasks")
 
     args = parser.parse_args()
 
@@ -109,6 +122,7 @@ def main():
         data_mover.CopyPush(),  # Upload data through e.g. scp or gridftp to this location where cax running
         #tsm_mover.AddTSMChecksum(), # Add forgotten Checksum for runDB for TSM client.
         checksum.CompareChecksums(),  # See if local data corrupted
+        checksum.AuditChecksums(),  # Re-read some local files each time to catch bit rot, if set in cax.json
         clear.RetryStalledTransfer(),  # If data transferring e.g. 48 hours, probably cax crashed so delete then retry
         clear.RetryBadChecksumTransfer(),  # If bad checksum for local data and can fetch from somewhere else, delete our copy
 
@@ -126,27 +140,48 @@ def main():
 
     user_tasks = config.get_task_list()
 
+    # Skip tasks that user did not specify
+    if user_tasks:
+        tasks = [task for task in tasks
+                 if task.__class__.__name__ in user_tasks]
+
+    # Follow changes to the runs DB unless a single run was requested
+    tracker = None
+    if args.incremental and args.run is None and args.name is None:
+        tracker = sweep.ChangeTracker(config.mongo_collection(),
+                                      args.state_file,
+                                      datetime.timedelta(hours=args.full_sweep))
+
+    specify_run = args.name if args.name is not None else args.run
+
     while True:
-        for task in tasks:
-            name = task.__class__.__name__
+        restrict = None
+        if tracker is not None:
+            restrict = tracker.start_sweep()
 
-            # Skip tasks that user did not specify
-            if user_tasks and name not in user_tasks:
-                continue
+        if args.single_pass:
+            logging.info("Executing %s in a single pass." %
+                         ', '.join(task.__class__.__name__ for task in tasks))
 
-            logging.info("Executing %s." % name)
+            sweep.Dispatcher(tasks).go(specify_run, restrict)
 
-            try:
-                if args.name is not None:
-                    task.go(args.name)
-                else:
-                    task.go(args.run)
+        else:
+            for task in tasks:
+                name = task.__class__.__name__
 
-            except Exception as e:
-                logging.fatal("Exception caught from task %s" % name,
-                              exc_info=True)
-                logging.exception(e)
-                raise
+                logging.info("Executing %s." % name)
+
+                try:
+                    task.go(specify_run, restrict)
+
+                except Exception as e:
+                    logging.fatal("Exception caught from task %s" % name,
+                                  exc_info=True)
+                    logging.exception(e)
+                    raise
+
+        if tracker is not None:
+            tracker.end_sweep()
 
         # Decide to continue or not
         if run_once:
@@ -155,6 +190,9 @@ def main():
             logging.info('Sleeping.')
             time.sleep(60)
 
+    # Pooled SSH connections are kept alive between sweeps until here
+    transfer.close_ssh_transports()
+
 
 def massive():
     # Command line arguments setup
@@ -362,6 +400,27 @@ def move():
                             args.output).go()
 
 
+def checksum_location():
+    parser = argparse.ArgumentParser(description="Checksum one data location "
+                                                 "and notify the run database.")
+    parser.add_argument('--run', type=int, required=True,
+                        help="Run number")
+    parser.add_argument('--location', type=str, required=True,
+                        help="Location of the file or folder to checksum")
+    parser.add_argument('--disable_database_update', action='store_true',
+                        help="Disable the update function the run data base")
+
+    args = parser.parse_args()
+
+    database_log = not args.disable_database_update
+
+    # Set information to update the run database
+    config.set_database_log(database_log)
+    config.mongo_password()
+
+    checksum.ChecksumSingle(args.location).go(args.run)
+
+
 def remove():
     parser = argparse.ArgumentParser(description="Remove data and notify"
                                                  " the run database.")
@@ -392,6 +451,67 @@ def stray():
 
     filesystem.FindStrays().go()
 
+def index():
+    parser = argparse.ArgumentParser(description="Check the indexes of the "
+                                                 "runs collection against the "
+                                                 "queries cax issues.")
+    parser.add_argument('--create', action='store_true',
+                        help="Create missing indexes (default: false)")
+
+    args = parser.parse_args()
+    config.mongo_password()
+
+    collection = config.mongo_collection()
+    existing = indexes.live_indexes(collection)
+
+    print("Query shapes:")
+    for name, query in sorted(indexes.QUERY_SHAPES.items()):
+        keys = indexes.serving_index(query, existing)
+        print("  %-20s %s" % (name, keys if keys else "NOT INDEXED"))
+
+    missing = indexes.missing_indexes(collection)
+    if not missing:
+        print("All indexes present")
+        return
+
+    print("Missing indexes:")
+    for keys, reason in missing:
+        print("  %s (%s)" % (keys, reason))
+
+    if args.create:
+        for name in indexes.create_indexes(collection):
+            print("Created %s" % name)
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark the checksum "
+                                                 "code, prints JSON.")
+    parser.add_argument('--location', type=str,
+                        help="Dataset directory to hash (default: synthetic)")
+    parser.add_argument('--files', type=int, default=8,
+                        help="Files in the synthetic dataset")
+    parser.add_argument('--size', type=int, default=64,
+                        help="Size of each synthetic file in MB")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="Numbers of hashing threads to try")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Repetitions, the best time is kept")
+    parser.add_argument('--block-sizes', type=int, nargs='+',
+                        default=[size // 1024 for size in benchmark.BLOCKSIZES],
+                        help="Read block sizes to try in kB")
+    parser.add_argument('--output', type=str,
+                        help="Also write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    results = benchmark.run(args.location, args.files, args.size * 1024 * 1024,
+                            args.workers, args.repeat,
+                            [size * 1024 for size in args.block_sizes])
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
 def status():
     #Ask the database for the actual status of the file or folder:
     
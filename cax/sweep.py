@@ -0,0 +1,230 @@
+"""Decide which runs a daemon sweep visits and which tasks see them
+
+Most run documents do not change between two sweeps of the cax daemon.  The
+ChangeTracker follows a MongoDB change stream on the runs collection so that a
+sweep only visits the runs modified since the previous one.  The change stream
+resume token is the high-water mark and is persisted to a local state file,
+so a restarted daemon picks up where it stopped.
+
+Tasks that act on elapsed time rather than on changes (stalled transfers,
+purging) still need to see every run, hence a full sweep is done periodically.
+Without change stream support (standalone servers, mongomock) every sweep is
+a full sweep.
+
+The Dispatcher hands every run document of a sweep to all tasks, instead of
+each task reading the whole runs collection on its own.
+"""
+
+import datetime
+import logging
+import os
+
+import pymongo
+from bson import json_util
+
+from cax import config
+
+
+class ChangeTracker:
+    """Track run documents changed since the last sweep"""
+
+    def __init__(self, collection, state_file,
+                 full_sweep_interval=datetime.timedelta(hours=6)):
+        self.collection = collection
+        self.state_file = state_file
+        self.full_sweep_interval = full_sweep_interval
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.stream = None
+        self.supported = True
+        self.resume_token = None
+        self.last_full_sweep = None
+        self.load()
+
+    def load(self):
+        """Read the high-water mark of a previous daemon"""
+        if not os.path.isfile(self.state_file):
+            return
+
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json_util.loads(f.read())
+        except ValueError:
+            self.log.warning("Cannot parse %s, starting from full sweep" %
+                             self.state_file)
+            return
+
+        self.resume_token = state.get('resume_token')
+        self.last_full_sweep = state.get('last_full_sweep')
+
+        # json_util gives back timezone aware UTC times
+        if self.last_full_sweep is not None:
+            self.last_full_sweep = self.last_full_sweep.replace(tzinfo=None)
+
+    def save(self):
+        """Persist the high-water mark"""
+        state = {'resume_token': self.resume_token,
+                 'last_full_sweep': self.last_full_sweep}
+
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json_util.dumps(state))
+        os.replace(tmp_file, self.state_file)
+
+    def open_stream(self):
+        """Open the change stream, resuming from the stored token if possible
+
+        Returns False if the stream could not be resumed, in which case
+        changes may have been missed.
+        """
+        try:
+            self.stream = self.collection.watch(resume_after=self.resume_token)
+            return self.resume_token is not None
+        except pymongo.errors.OperationFailure as e:
+            if self.resume_token is None:
+                raise
+            # Token fell off the oplog
+            self.log.warning("Cannot resume change stream: %s" % e)
+
+        self.resume_token = None
+        self.stream = self.collection.watch()
+        return False
+
+    def changed_ids(self):
+        """Drain the change stream, returns None if a change may be missed"""
+        if self.stream is None:
+            if not self.open_stream():
+                self.resume_token = self.stream.resume_token
+                return None
+
+        ids = set()
+        while True:
+            change = self.stream.try_next()
+            if change is None:
+                break
+
+            if change['operationType'] == 'invalidate':
+                # Collection dropped or renamed
+                self.stream.close()
+                self.stream = None
+                self.resume_token = None
+                return None
+
+            if 'documentKey' in change:
+                ids.add(change['documentKey']['_id'])
+
+        self.resume_token = self.stream.resume_token
+        return ids
+
+    def start_sweep(self):
+        """Returns the query restricting this sweep, None for a full sweep"""
+        now = datetime.datetime.utcnow()
+
+        ids = None
+        if self.supported:
+            try:
+                ids = self.changed_ids()
+            # Standalone servers raise, mongomock has no watch at all
+            except (pymongo.errors.PyMongoError, NotImplementedError,
+                    TypeError) as e:
+                self.log.warning("Change streams not available (%s), "
+                                 "using full sweeps" % e)
+                self.supported = False
+                self.stream = None
+
+        if ids is None or self.last_full_sweep is None or \
+                now - self.last_full_sweep > self.full_sweep_interval:
+            self.log.info("Full sweep")
+            self.last_full_sweep = now
+            return None
+
+        self.log.info("Incremental sweep over %d changed runs" % len(ids))
+        return {'_id': {'$in': list(ids)}}
+
+    def end_sweep(self):
+        """Call once all tasks went over the runs of this sweep"""
+        if self.supported:
+            self.save()
+
+
+class Dispatcher:
+    """Run several tasks over a single pass of the runs collection
+
+    Each run document is read once and handed to every task in turn.  It is
+    only read again when a task wrote to the runs DB directly: the updates
+    tasks buffer are sent once every task had the run.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def go(self, specify_run=None, restrict=None):
+        if not self.tasks:
+            return
+
+        # Any task can do the reading
+        reader = self.tasks[0]
+
+        # Get user-specified list of datasets
+        datasets = config.get_dataset_list()
+
+        ids = reader.find_run_ids(specify_run, restrict, datasets,
+                                  self.run_filter())
+        if ids is None:
+            return
+
+        projection = self.projection()
+
+        for run_doc in reader.fetch_run_docs(ids, projection):
+            try:
+                for task in self.tasks:
+                    if self.run_task(task, run_doc, datasets):
+                        run_doc = reader.collection.find_one({'_id': run_doc['_id']},
+                                                             projection=projection)
+
+                        # Run removed
+                        if run_doc is None:
+                            break
+            finally:
+                # Once per run, also keeping the updates made before an error
+                for task in self.tasks:
+                    task.writes.flush()
+
+        for task in self.tasks:
+            task.shutdown()
+
+    def run_filter(self):
+        """Returns a query matching runs any of the tasks may act on"""
+        filters = []
+        for task in self.tasks:
+            task_filter = task.run_filter()
+            if task_filter is None:
+                return None
+            filters.append(task_filter)
+
+        return {'$or': filters}
+
+    def projection(self):
+        """Returns the fields read by any of the tasks, None for all"""
+        fields = set()
+        for task in self.tasks:
+            task_fields = task.projection()
+            if task_fields is None:
+                return None
+            fields.update(task_fields)
+
+        # Overlapping paths like 'reader' and 'reader.ini' are not allowed
+        return sorted(field for field in fields
+                      if not any(field.startswith(other + '.')
+                                 for other in fields))
+
+    def run_task(self, task, run_doc, datasets):
+        """Returns True if the task modified the run"""
+        try:
+            task.handle_run(run_doc, datasets)
+            return task.collection.modified
+        except Exception:
+            self.log.fatal("Exception caught from task %s" %
+                           task.__class__.__name__, exc_info=True)
+            raise
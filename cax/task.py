@@ -1,5 +1,9 @@
 
+import concurrent.futures
+import copy
 import logging
+import threading
+import time
 from json import loads
 
 import pymongo
@@ -8,63 +12,305 @@ from bson.json_util import dumps
 from cax import config
 
 
+class TrackedCollection:
+    """Wrap a pymongo collection to know if it was written to
+
+    Any write sets the modified attribute, which the caller resets.
+    """
+    write_methods = ('update', 'update_one', 'update_many', 'replace_one',
+                     'find_one_and_update', 'find_one_and_replace',
+                     'find_one_and_delete', 'delete_one', 'delete_many',
+                     'insert', 'insert_one', 'insert_many', 'bulk_write')
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.modified = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+        if name not in self.write_methods:
+            return attribute
+
+        def write(*args, **kwargs):
+            self.modified = True
+            return attribute(*args, **kwargs)
+        return write
+
+
+class WriteBuffer:
+    """Collect run DB updates and send them in ordered bulk writes
+
+    Updates are sent once max_size of them are waiting, or when flush() is
+    called.  Flush before any step that relies on the update being done.
+    The worker threads of a task share its buffer.
+    """
+
+    def __init__(self, collection, max_size=100):
+        self.collection = collection
+        self.max_size = max_size
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def update(self, filter, update):
+        """Queue an update of the first document matching filter"""
+        with self.lock:
+            self.requests.append(pymongo.UpdateOne(filter, update))
+            full = len(self.requests) >= self.max_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Send the waiting updates, in the order they were made"""
+        with self.lock:
+            requests, self.requests = self.requests, []
+
+            if not requests:
+                return None
+
+            try:
+                return self.collection.bulk_write(requests, ordered=True)
+            except pymongo.errors.BulkWriteError as e:
+                logging.error("Bulk write failed: %s" % e.details)
+                raise
+
+
 class Task:
+    # Run documents fetched per query in go().  A value of 1 (or None) falls
+    # back to one find_one per run.  Can be overridden per host in cax.json.
+    batch_size = 200
+
+    # Seconds a batched run document may wait before being handed to
+    # each_run.  Older documents are read again so tasks act on fresh data.
+    max_staleness = 60
+
+    # Number of runs handled concurrently by go(), each in its own thread.
+    # Can be overridden per task and per host with 'workers' in cax.json.
+    workers = 1
+
+    # Updates sent to the run DB in one bulk write, see WriteBuffer
+    write_batch_size = 100
+
+    # Run document fields each_run reads on top of _id and base_fields, e.g.
+    # 'start' or 'processor.DEFAULT'.  None reads the whole document.
+    fields = None
+    base_fields = ('number', 'name', 'data')
+
     def __init__(self):
         # Grab the Run DB so we can query it
-        self.collection = config.mongo_collection()
+        self.collection = TrackedCollection(config.mongo_collection())
+        self.writes = WriteBuffer(self.collection, self.write_batch_size)
         self.log = logging.getLogger(self.__class__.__name__)
         self.run_doc = None
         self.untriggered_data = None
 
-    def go(self, specify_run = None):
-        """Run this periodically"""
+    def go(self, specify_run = None, restrict = None):
+        """Run this periodically
+
+        restrict is an optional query limiting the runs visited, e.g. to the
+        runs that changed since the last sweep.
+        """
+        # Get user-specified list of datasets
+        datasets = config.get_dataset_list()
+
+        ids = self.find_run_ids(specify_run, restrict, datasets,
+                                self.run_filter())
+        if ids is None:
+            return
+
+        workers = config.get_workers(self.__class__.__name__)
+        if workers is None:
+            workers = self.workers
+
+        try:
+            if workers > 1:
+                self.go_parallel(ids, datasets, workers)
+            else:
+                # Iterate over each run
+                for run_doc in self.fetch_run_docs(ids, self.projection()):
+                    self.handle_run(run_doc, datasets)
+        finally:
+            # Keep the updates of the runs done before any error
+            self.writes.flush()
+
+        self.shutdown()
+
+    def go_parallel(self, ids, datasets, workers):
+        """Handle runs with a pool of worker threads
+
+        Run documents are only fetched once a worker is free so they do not
+        go stale while waiting.  The first exception raised by a worker is
+        raised again once all runs are done.
+        """
+        self.log.debug("Using %d workers" % workers)
+
+        slots = threading.BoundedSemaphore(workers)
+        futures = []
+        run_docs = self.fetch_run_docs(ids, self.projection())
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                slots.acquire()
+                run_doc = next(run_docs, None)
+                if run_doc is None:
+                    slots.release()
+                    break
+
+                future = pool.submit(self.handle_run_in_worker, run_doc,
+                                     datasets)
+                future.add_done_callback(lambda future: slots.release())
+                futures.append(future)
+
+        for future in futures:
+            future.result()
+
+    def handle_run_in_worker(self, run_doc, datasets=None):
+        """Handle a run on a copy of this task
 
-        query = {}
+        Each run is handed to a single worker.  Workers share the write
+        buffer, which has a lock of its own.
+        """
+        worker = copy.copy(self)
+        worker.collection = TrackedCollection(self.collection.collection)
+        return worker.handle_run(run_doc, datasets)
+
+    def find_run_ids(self, specify_run = None, restrict = None,
+                     datasets = None, run_filter = None):
+        """Returns ids of the runs to visit, newest first
+
+        Returns None if the query failed.
+        """
+        clauses = []
+        if restrict is not None:
+            clauses.append(restrict)
 
         # argument can be run number or run name
         if specify_run is not None:
             if isinstance(specify_run,int):
-                query['number'] = specify_run
+                clauses.append({'number': specify_run})
             elif isinstance(specify_run,str):
-                query['name'] = specify_run
+                clauses.append({'name': specify_run})
 
-        # Get user-specified list of datasets
-        datasets = config.get_dataset_list()
+        # Operate on only user-specified datasets
+        if datasets:
+            clauses.append({'name': {'$in': datasets}})
+
+        # Let the DB drop runs the task has nothing to do with
+        if run_filter is not None:
+            clauses.append(run_filter)
+
+        if len(clauses) > 1:
+            query = {'$and': clauses}
+        elif clauses:
+            query = clauses[0]
+        else:
+            query = {}
 
         # Collect all run document ids.  This has to be turned into a list
         # to avoid timeouts if a task takes too long.
         try:
-            ids = [doc['_id'] for doc in self.collection.find(query,
-                                                              projection=('_id'),
-                                                              sort=(('start', -1),))]
+            return [doc['_id'] for doc in self.collection.find(query,
+                                                               projection=('_id'),
+                                                               sort=(('start', -1),))]
         except pymongo.errors.CursorNotFound:
             self.log.warning("Cursor not found exception.  Skipping")
+            return None
+
+    def handle_run(self, run_doc, datasets=None):
+        """Run each_run on a single run document
+
+        Returns True if the task wrote to the runs DB meanwhile, in which
+        case run_doc is out of date.
+        """
+        self.run_doc = run_doc
+        self.collection.modified = False
+
+        if 'data' not in self.run_doc:
+            return False
+
+        # Operate on only user-specified datasets
+        if datasets:
+            if self.run_doc['name'] not in datasets:
+                return False
+
+        # DAQ experts only:
+        # Find location of untriggered DAQ data (if exists)
+        self.untriggered_data = self.get_daq_buffer()
+
+        self.each_run()
+
+        return self.collection.modified
+
+    def run_filter(self):
+        """Returns a query matching the runs this task may act on
+
+        This is only an optimization: each_run must still check on its own,
+        as other tasks' runs are handed over too in a single pass.  None
+        visits every run.
+        """
+        return None
+
+    def projection(self):
+        """Returns the run document fields this task reads, None for all"""
+        if self.fields is None:
+            return None
+        return list(self.base_fields) + list(self.fields)
+
+    def fetch_run_docs(self, ids, projection=None):
+        """Yield the run documents for ids, keeping their order
+
+        Documents are fetched in batches with a single $in query each.  A
+        document that waited more than max_staleness seconds before being
+        handed out is read again.
+        """
+        batch_size = config.get_batch_size()
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        if not batch_size or batch_size <= 1:
+            for id in ids:
+                try:
+                    doc = self.collection.find_one({'_id': id},
+                                                   projection=projection)
+                except pymongo.errors.AutoReconnect:
+                    self.log.error("pymongo.errors.AutoReconnect, skipping...")
+                    continue
+                if doc is not None:
+                    yield doc
             return
 
-        # Iterate over each run
-        for id in ids:
-            # Make sure up to date
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
             try:
-                self.run_doc = self.collection.find_one({'_id': id})
+                docs = {doc['_id']: doc for doc in
+                        self.collection.find({'_id': {'$in': batch}},
+                                             projection=projection)}
             except pymongo.errors.AutoReconnect:
-                self.log.error("pymongo.errors.AutoReconnect, skipping...")
-                continue
-
-            if 'data' not in self.run_doc:
+                self.log.error("pymongo.errors.AutoReconnect, skipping "
+                               "batch of %d runs..." % len(batch))
                 continue
+            fetched = time.time()
 
-            # Operate on only user-specified datasets
-            if datasets:
-                if self.run_doc['name'] not in datasets:
+            for id in batch:
+                # Run was removed since the ids were collected
+                if id not in docs:
                     continue
 
-            # DAQ experts only:
-            # Find location of untriggered DAQ data (if exists)
-            self.untriggered_data = self.get_daq_buffer()
+                doc = docs.pop(id)
 
-            self.each_run()
+                # Previous runs in this batch took long, so make sure up to date
+                if time.time() - fetched > self.max_staleness:
+                    try:
+                        doc = self.collection.find_one({'_id': id},
+                                                       projection=projection)
+                    except pymongo.errors.AutoReconnect:
+                        self.log.error("pymongo.errors.AutoReconnect, "
+                                       "skipping...")
+                        continue
+                    if doc is None:
+                        continue
 
-        self.shutdown()
+                yield doc
 
     def each_run(self):
         for data_doc in self.run_doc['data']:
@@ -1,17 +1,366 @@
 """Responsible for all checksum operations on data.
 """
 
+import concurrent.futures
+import datetime
 import hashlib
 import os
+import random
+import sqlite3
+import threading
+import time
 
 import checksumdir
 import shutil
+from collections import defaultdict
 import subprocess
 from zlib import adler32, crc32
 
-from cax import config
+from cax import config, qsub
+from cax.transfer import TransferProcess
 from ..task import Task
 
+# Files hashed concurrently by dirhash, unless set in cax.json
+CHECKSUM_WORKERS = 4
+
+# Bytes read at once when checksumming, unless set in cax.json
+BLOCKSIZE = 1024 * 1024
+
+# Read buffers, one per thread
+_buffers = threading.local()
+
+# Digests computed together whenever a file is read: sha512 for the runs DB,
+# adler32 for Rucio and crc32 for the tape pre-test
+ALGORITHMS = ('sha512', 'adler32', 'crc32')
+
+
+class ChecksumCache:
+    """Per-file digests kept in a local SQLite database
+
+    A digest is only given back while the file keeps the size, modification
+    time and inode it had when it was hashed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # SQLite connections cannot be shared between threads
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.execute("CREATE TABLE IF NOT EXISTS digests ("
+                               "path TEXT, algorithm TEXT, size INTEGER, "
+                               "mtime INTEGER, inode INTEGER, digest TEXT, "
+                               "PRIMARY KEY (path, algorithm))")
+            self.local.connection = connection
+        return self.local.connection
+
+    def get(self, path, algorithm, stat):
+        """Returns the digest of the file, None if unknown or out of date"""
+        row = self.connection().execute(
+            "SELECT digest FROM digests WHERE path = ? AND algorithm = ? AND "
+            "size = ? AND mtime = ? AND inode = ?",
+            (path, algorithm, stat.st_size, stat.st_mtime_ns,
+             stat.st_ino)).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, path, stat, digests):
+        """Store a dict of digests by algorithm"""
+        with self.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, algorithm, stat.st_size, stat.st_mtime_ns,
+                  stat.st_ino, digest) for algorithm, digest in digests.items()])
+
+
+class AuditLog:
+    """When each file was last audited, kept in a local SQLite database"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.execute("CREATE TABLE IF NOT EXISTS audits ("
+                               "path TEXT PRIMARY KEY, time REAL)")
+            self.local.connection = connection
+        return self.local.connection
+
+    def last_audits(self):
+        """Returns a dict of audit times by path"""
+        return dict(self.connection().execute("SELECT path, time FROM audits"))
+
+    def audited(self, path, when):
+        with self.connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO audits VALUES (?, ?)",
+                               (path, when))
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def checksum_cache():
+    """Returns the checksum cache of this host, None if there is none"""
+    filename = config.get_checksum_cache()
+    if not filename:
+        return None
+
+    with _CACHES_LOCK:
+        if filename not in _CACHES:
+            _CACHES[filename] = ChecksumCache(filename)
+        return _CACHES[filename]
+
+
+def read_blocks(f, blocksize=None):
+    """Yield the content of a binary file in blocks of blocksize bytes
+
+    Blocks are read into a buffer kept per thread and yielded as views of
+    it, so that no memory is allocated per block.  A block is only valid
+    until the next one is read.
+    """
+    if blocksize is None:
+        blocksize = config.get_checksum_blocksize() or BLOCKSIZE
+
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != blocksize:
+        buffer = _buffers.buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+
+    while True:
+        size = f.readinto(buffer)
+        if not size:
+            break
+        yield view[:size]
+
+
+class Digester:
+    """Computes several digests of the same data at once
+
+    algorithms can be any of hashlib's and 'adler32' or 'crc32'.
+    """
+
+    def __init__(self, algorithms):
+        self.algorithms = tuple(algorithms)
+        self.hashers = {}
+        for algorithm in self.algorithms:
+            if algorithm not in ('adler32', 'crc32'):
+                hash_func = checksumdir.HASH_FUNCS.get(algorithm)
+                if not hash_func:
+                    raise NotImplementedError("%s not implemented." % algorithm)
+                self.hashers[algorithm] = hash_func()
+        self.asum = 1
+        self.prev = 0
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        if 'adler32' in self.algorithms:
+            self.asum = adler32(data, self.asum)
+        if 'crc32' in self.algorithms:
+            self.prev = crc32(data, self.prev)
+
+    def hexdigests(self):
+        """Returns the digests by algorithm, as stored in the runs DB"""
+        digests = {algorithm: hasher.hexdigest()
+                   for algorithm, hasher in self.hashers.items()}
+        if 'adler32' in self.algorithms:
+            digests['adler32'] = "%08x" % (self.asum & 0xFFFFFFFF)
+        if 'crc32' in self.algorithms:
+            digests['crc32'] = "%X" % (self.prev & 0xFFFFFFFF)
+        return digests
+
+
+def compute_digests(path, algorithms, blocksize=None):
+    """Reads the file once, returns its digests as stored in the runs DB"""
+    digester = Digester(algorithms)
+
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        # Like checksumdir, a missing file has the digest of no data
+        if len(digester.hashers) < len(digester.algorithms):
+            raise
+        return digester.hexdigests()
+
+    with f:
+        for data in read_blocks(f, blocksize):
+            digester.update(data)
+
+    return digester.hexdigests()
+
+
+def file_digests(path, algorithms=ALGORITHMS):
+    """Digests of a file, reading it at most once
+
+    With a checksum cache, digests still valid are taken from it.  Missing
+    ones are computed together with all of ALGORITHMS, so later requests
+    for another algorithm do not read the file again.
+    """
+    cache = checksum_cache()
+    if cache is None:
+        return compute_digests(path, algorithms)
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return compute_digests(path, algorithms)
+
+    digests = {}
+    for algorithm in algorithms:
+        digest = cache.get(path, algorithm, stat)
+        if digest is not None:
+            digests[algorithm] = digest
+
+    if len(digests) == len(algorithms):
+        return digests
+
+    computed = compute_digests(path, set(algorithms) | set(ALGORITHMS))
+
+    # Do not remember digests of a file changing meanwhile
+    after = os.stat(path)
+    if (after.st_size, after.st_mtime_ns, after.st_ino) == \
+            (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+        cache.put_many(path, stat, computed)
+
+    return {algorithm: computed[algorithm] for algorithm in algorithms}
+
+
+def file_digest(path, algorithm='sha512'):
+    """Digest of a file, see file_digests"""
+    return file_digests(path, (algorithm,))[algorithm]
+
+
+class DigestHandle:
+    """Digests of files computed earlier in a pipeline
+
+    The stages of a pipeline, e.g. a tape upload, share a handle so that a
+    file is read at most once for all its digests.  Digests are kept in
+    memory for as long as the handle lives, files are not expected to change
+    meanwhile.  A handle used to verify data is not cached, so that files are
+    actually read.
+    """
+
+    def __init__(self, cached=True):
+        self.digests = {}
+        self.cached = cached
+
+    def file_digests(self, path, algorithms=ALGORITHMS):
+        known = self.digests.setdefault(os.path.abspath(path), {})
+        if not all(algorithm in known for algorithm in algorithms):
+            wanted = tuple(set(algorithms) | set(ALGORITHMS))
+            if self.cached:
+                known.update(file_digests(path, wanted))
+            else:
+                known.update(compute_digests(path, wanted))
+        return {algorithm: known[algorithm] for algorithm in algorithms}
+
+    def file_digest(self, path, algorithm='sha512'):
+        return self.file_digests(path, (algorithm,))[algorithm]
+
+    def dirhash(self, location, hashfunc='sha512'):
+        """Same as checksumdir.dirhash"""
+        return checksumdir._reduce_hash([self.file_digest(f, hashfunc) for f in
+                                         dataset_files(location)],
+                                        checksumdir.HASH_FUNCS[hashfunc])
+
+
+def dataset_files(location):
+    """Returns the files of a directory, in the order checksumdir visits them"""
+    if not os.path.isdir(location):
+        raise TypeError("%s is not a directory." % location)
+
+    files = []
+    for root, dirs, filenames in os.walk(location, topdown=True):
+        dirs.sort()
+        for filename in sorted(filenames):
+            files.append(os.path.join(root, filename))
+    return files
+
+
+def file_checksums(location, hashfunc='sha512', workers=None, cached=True):
+    """Returns [path, digest] of every file of a directory
+
+    Paths are relative to location.  Several files are hashed at once:
+    hashlib releases the GIL on large buffers, so threads are enough to keep
+    several cores busy.  Without cached, every file is read, as needed to
+    verify data: the checksum cache cannot tell a file rewritten with the
+    same size and time.
+    """
+    if workers is None:
+        workers = config.get_checksum_workers() or CHECKSUM_WORKERS
+
+    files = dataset_files(location)
+
+    if cached:
+        digest = lambda f: file_digest(f, hashfunc)
+    else:
+        digest = lambda f: compute_digests(f, (hashfunc,))[hashfunc]
+
+    if workers <= 1 or len(files) <= 1:
+        values = [digest(f) for f in files]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            values = list(pool.map(digest, files))
+
+    return [[os.path.relpath(f, location).replace(os.sep, '/'), value]
+            for f, value in zip(files, values)]
+
+
+def reduce_checksums(files, hashfunc='sha512'):
+    """Dataset checksum of file_checksums, same as checksumdir.dirhash"""
+    return checksumdir._reduce_hash([value for path, value in files],
+                                    checksumdir.HASH_FUNCS[hashfunc])
+
+
+def dirhash(location, hashfunc='sha512', workers=None, cached=True):
+    """Same as checksumdir.dirhash, but hashing several files at once"""
+    if hashfunc not in checksumdir.HASH_FUNCS:
+        raise NotImplementedError("%s not implemented." % hashfunc)
+
+    return reduce_checksums(file_checksums(location, hashfunc, workers,
+                                           cached),
+                            hashfunc)
+
+
+def merkle_root(files):
+    """Root of a sha512 Merkle tree over file_checksums
+
+    Leaves hash the path and digest of each file, so renaming a file changes
+    the root too.
+    """
+    nodes = [hashlib.sha512(b'\x00' + path.encode('utf-8') + b'\x00' +
+                            value.encode('utf-8')).digest()
+             for path, value in sorted(files)]
+    if not nodes:
+        return hashlib.sha512().hexdigest()
+
+    while len(nodes) > 1:
+        pairs = [nodes[i:i + 2] for i in range(0, len(nodes), 2)]
+        # An odd node out goes up a level as is
+        nodes = [hashlib.sha512(b'\x01' + b''.join(pair)).digest()
+                 if len(pair) == 2 else pair[0] for pair in pairs]
+    return nodes[0].hex()
+
+
+def mismatched_files(data_doc, reference):
+    """Returns the local files of data_doc that do not match reference
+
+    Files missing from reference count as mismatched, files missing from
+    data_doc do not as there is nothing to delete.  Returns None if there is
+    no reference or either entry has no per-file checksums.
+    """
+    if reference is None or 'files' not in data_doc or \
+            'files' not in reference:
+        return None
+
+    expected = dict(reference['files'])
+    return [path for path, value in data_doc['files']
+            if expected.get(path) != value]
+
 
 class ChecksumMethods():
     """Implement own checksum methods"""
@@ -20,28 +369,14 @@ class ChecksumMethods():
         """Calcualte an Adler32 checksum in python
             Used for cross checks with Rucio
         """
-        BLOCKSIZE=256*1024*1024
-        asum = 1
-        with open(fname, "rb") as f:
-          while True:
-            data = f.read(BLOCKSIZE)
-            if not data:
-                break
-            asum = adler32(data, asum)
-            if asum < 0:
-                asum += 2**32
-
-        return hex(asum)[2:10].zfill(8).lower()
+        return file_digest(fname, 'adler32')
 
     def get_crc32(self, fname):
         """Calcualte an crc32 checksum in python
             Used for cross checks for tape uploads
             2^32 hashes allow to calculate a quick checksum
         """
-        prev = 0
-        for eachLine in open(fname,"rb"):
-          prev = crc32(eachLine, prev)
-        return "%X"%(prev & 0xFFFFFFFF)
+        return file_digest(fname, 'crc32')
 
 class AddChecksum(Task):
     """Perform a checksum on accessible data.
@@ -49,6 +384,23 @@ class AddChecksum(Task):
     If no previous checksum present, then adds one.  Otherwise, confirms the
     checksum still is true.
     """
+    fields = ()
+
+    # Leave large datasets to a batch job, see offload_checksum
+    offload = True
+
+    # Hours a checksum job may be missing from the queue before resubmitting
+    offload_grace = 1
+
+    def run_filter(self):
+        hosts = [config.get_hostname()]
+
+        # Special case of midway-srm accessible via POSIX on midway-login1
+        if config.get_hostname() == 'midway-login1':
+            hosts.append('midway-srm')
+
+        return {'data': {'$elemMatch': {'status': 'verifying',
+                                        'host': {'$in': hosts}}}}
 
     def each_location(self, data_doc):
         # Only data waiting to be verified
@@ -73,16 +425,20 @@ class AddChecksum(Task):
                 self.log.debug('Location not here')
                 return
 
+        if self.offload and self.offload_checksum(data_doc):
+            return
+
         # This status is given after checksumming
         status = 'transferred'
 
         # Find file and perform checksum
+        files = None
         if os.path.isdir(data_doc['location']):
-            value = checksumdir.dirhash(data_doc['location'],
-                                        'sha512')
+            files = file_checksums(data_doc['location'], 'sha512')
+            value = reduce_checksums(files, 'sha512')
         elif os.path.isfile(data_doc['location']):
-            value = checksumdir._filehash(data_doc['location'],
-                                          hashlib.sha512)
+            value = file_digest(data_doc['location'], 'sha512')
+            files = [[os.path.basename(data_doc['location']), value]]
         else:
             # Data not actually found
             self.log.error("Location %s not found." % data_doc['location'])
@@ -94,49 +450,181 @@ class AddChecksum(Task):
                 self.log.info("Adding a checksum to run "
                               "%d %s" % (self.run_doc['number'],
                                          data_doc['type']))
-                self.collection.update({'_id' : self.run_doc['_id'],
-                                        'data': {'$elemMatch': data_doc}},
-                                       {'$set': {'data.$.status'  : status,
-                                                 'data.$.checksum': value}})
+                update = {'data.$.status'  : status,
+                          'data.$.checksum': value}
+
+                # Per-file checksums, to tell which files are bad later
+                if files is not None:
+                    update['data.$.files'] = files
+                    update['data.$.merkle_root'] = merkle_root(files)
+
+                update = {'$set': update}
+                if 'checksum_job' in data_doc:
+                    update['$unset'] = {'data.$.checksum_job': ''}
+
+                self.writes.update({'_id' : self.run_doc['_id'],
+                                    'data': {'$elemMatch': data_doc}},
+                                   update)
             elif data_doc['checksum'] != value or status == 'error':
                 self.log.info("Checksum fail "
                               "%d %s" % (self.run_doc['number'],
                                          data_doc['type']))
-                self.collection.update({'_id' : self.run_doc['_id'],
-                                        'data': {'$elemMatch': data_doc}},
-                                       {'$set': {'data.$.checksumproblem': True}})
+                self.writes.update({'_id' : self.run_doc['_id'],
+                                    'data': {'$elemMatch': data_doc}},
+                                   {'$set': {'data.$.checksumproblem': True}})
+
+
+
+    def offload_checksum(self, data_doc):
+        """Submit the checksum of a large directory as a batch job
+
+        The job runs cax-checksum, which reports to the run DB.  Returns True
+        if the checksum is left to a job, pending or just submitted.
+        """
+        settings = config.get_checksum_offload()
+        if settings is None or not os.path.isdir(data_doc['location']):
+            return False
+
+        size = sum(os.path.getsize(f) for f in
+                   dataset_files(data_doc['location']))
+        if size < settings.get('min_bytes', 1e12):
+            return False
+
+        # Job names are <use>_<number>_<pax version>, the use telling apart
+        # the entries of a run
+        use = 'checksum_' + data_doc['type']
+        if 'pax_version' in data_doc:
+            use += '_' + data_doc['pax_version']
+        name = '%s_%d_' % (use, self.run_doc['number'])
+
+        if 'checksum_job' in data_doc:
+            age = datetime.datetime.utcnow() - data_doc['checksum_job']
+            if age < datetime.timedelta(hours=self.offload_grace) or \
+                    any(job.startswith(name) for job in
+                        qsub.get_queue(config.get_hostname())):
+                self.log.debug("Checksum job of %s pending" %
+                               data_doc['location'])
+                return True
+            self.log.warning("Checksum job of %s gone, submitting again" %
+                             data_doc['location'])
+
+        try:
+            script = config.processing_script(
+                {'use': use,
+                 'number': self.run_doc['number'],
+                 'ncpus': settings.get('ncpus', CHECKSUM_WORKERS),
+                 'time': settings.get('time', '24:00:00'),
+                 'command': "cax-checksum --run %d --location %s" %
+                            (self.run_doc['number'], data_doc['location'])})
+        except ValueError:
+            # No batch queue here
+            return False
+
+        self.log.info("Submitting checksum of %s (%d GB)" %
+                      (data_doc['location'], size / 1e9))
+        qsub.submit_job(script)
+
+        if config.DATABASE_LOG:
+            self.writes.update({'_id' : self.run_doc['_id'],
+                                'data': {'$elemMatch': data_doc}},
+                               {'$set': {'data.$.checksum_job':
+                                         datetime.datetime.utcnow()}})
+        return True
+
+
+class ChecksumSingle(AddChecksum):
+    """Checksum one data location, as a batch job submitted by AddChecksum"""
+    offload = False
+
+    def __init__(self, location):
+        self.location = os.path.abspath(location)
+
+        # Perform base class initialization
+        AddChecksum.__init__(self)
+
+    def run_filter(self):
+        run_filter = AddChecksum.run_filter(self)
+        run_filter['data']['$elemMatch']['location'] = self.location
+        return run_filter
+
+    def each_location(self, data_doc):
+        if data_doc.get('location') != self.location:
+            return
 
+        AddChecksum.each_location(self, data_doc)
 
 
 class CompareChecksums(Task):
     "Perform a checksum on accessible data."
+    fields = ()
+
+    # These types of data and location provide master checksum
+    master_locations = (('raw', 'xe1t-datamanager'),
+                        ('raw', 'tsm-server'),
+                        ('processed', 'login'),
+                        ('processed', 'midway-login1'))
+
+    def __init__(self):
+        Task.__init__(self)
+        self.index_run_doc = None
+
+    def run_filter(self):
+        # Only local copies can be found bad
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'status': 'transferred'}}}
+
+    def run_index(self):
+        """Returns the transferred data entries by (type, host, pax_version)
+
+        Entries are listed with their position in the run document.  The
+        index, master locations and copy counts are worked out once per run.
+        """
+        if self.index_run_doc is not self.run_doc:
+            self.index = defaultdict(list)
+            for i, data_doc in enumerate(self.run_doc['data']):
+                if data_doc.get('status') == 'transferred':
+                    key = tuple((data_doc.get(key) for key in ('type',
+                                                               'host',
+                                                               'pax_version')))
+                    self.index[key].append((i, data_doc))
+
+            self.masters = {}
+            self.copies = {}
+            self.index_run_doc = self.run_doc
+        return self.index
 
     def get_main_checksum(self, type='raw', pax_version='', **kwargs):
         """Iterate over data locations and search for priviledged checksum
         """
+        data_doc = self.get_main_data_doc(type, pax_version)
+        if data_doc is None:
+            return None
+        return data_doc['checksum']
 
-        # These types of data and location provide master checksum
-        master_checksums = (('raw', 'xe1t-datamanager', None),
-                            ('raw', 'tsm-server', None),
-                            ('processed', 'login', pax_version),
-                            ('processed', 'midway-login1', pax_version))
+    def get_main_data_doc(self, type='raw', pax_version='', **kwargs):
+        """Search for the data location providing the priviledged checksum
+        """
+        index = self.run_index()
 
-        for data_doc in self.run_doc['data']:
+        # Only processed data is told apart by pax version
+        if type != 'processed':
+            pax_version = None
 
-            # Only look at transfered data
-            if data_doc['status'] == 'transferred' and data_doc['type'] == type:
+        if (type, pax_version) not in self.masters:
+            # First one in the run document
+            candidates = [index[key][0] for key in
+                          ((type, host, pax_version) for master_type, host in
+                           self.master_locations if master_type == type)
+                          if key in index]
+            master = min(candidates, key=lambda c: c[0])[1] if candidates else None
 
-                # Search key
-                test = tuple((data_doc.get(key) for key in ('type',
-                                                            'host',
-                                                            'pax_version')))
-                if test in master_checksums:
-                    # If matched a master checksum location, return checksum
-                    return data_doc['checksum']
+            if master is None:
+                self.log.debug("Missing master checksum for %s within %d "
+                               "(pax v%s)" % (type, self.run_doc['number'],
+                                              pax_version))
+            self.masters[(type, pax_version)] = master
 
-        self.log.debug("Missing master checksum for %s within %d (pax v%s)" % \
-                       (type, self.run_doc['number'], pax_version))
-        return None
+        return self.masters[(type, pax_version)]
 
     def check(self, type='raw',
               warn=True):
@@ -145,35 +633,47 @@ class CompareChecksums(Task):
         Return the number of sites that have the same checksum as the master
         site.
         """
+        index = self.run_index()
+
+        # Only errors differ if asked again
+        if not warn and type in self.copies:
+            return self.copies[type]
+
         n = 0
 
-        for data_doc in self.run_doc['data']:
+        for key, data_docs in index.items():
             # Only look at transfered data that is not untriggered
-            if 'host' not in data_doc or \
-                            data_doc['status'] != 'transferred' or \
-                            data_doc['type'] == 'untriggered' or \
-                            data_doc['type'] != type or \
-                            'checksum' not in data_doc:
+            if key[0] != type or key[0] == 'untriggered' or key[1] is None:
                 continue
 
-            # Rucio stores its own checksum, assume "transferred" is 1 good copy
-            if data_doc['host'] == 'rucio-catalogue':
-                n += 1
+            for i, data_doc in data_docs:
+                if 'checksum' not in data_doc:
+                    continue
 
-            # Grab main checksum and compare
-            elif data_doc['checksum'] != self.get_main_checksum(**data_doc):
+                # Rucio stores its own checksum, assume "transferred" is 1 good copy
+                if data_doc['host'] == 'rucio-catalogue':
+                    n += 1
 
-                if data_doc['host'] == config.get_hostname():
-                    error = "Local checksum error " \
-                            "run %d, %s %s" % (self.run_doc['number'], data_doc['type'], \
-                                            data_doc['pax_version'])
-                    if warn:
-                        self.give_error(error)
+                # Grab main checksum and compare
+                elif data_doc['checksum'] != self.get_main_checksum(**data_doc):
 
-            # Comparison did not fail so add 1 good copy
-            else:
-                n += 1
+                    if data_doc['host'] == config.get_hostname():
+                        error = "Local checksum error " \
+                                "run %d, %s %s" % (self.run_doc['number'], data_doc['type'], \
+                                                data_doc.get('pax_version'))
+
+                        bad_files = mismatched_files(data_doc,
+                                                     self.get_main_data_doc(**data_doc))
+                        if bad_files:
+                            error += ", bad files: %s" % ", ".join(bad_files)
+                        if warn:
+                            self.give_error(error)
 
+                # Comparison did not fail so add 1 good copy
+                else:
+                    n += 1
+
+        self.copies[type] = n
         return n
 
     def each_run(self):
@@ -196,26 +696,23 @@ class CompareChecksums(Task):
                 else:
                     grid_cert = config.get_cert()
 
-                full_command = "gfal-rm -v -r --cert %s " % grid_cert + \
-                               server+data_doc['location']
-
-                self.log.info(full_command)
+                full_command = ['gfal-rm', '-v', '-r']
+                if grid_cert:
+                    full_command += ['--cert', grid_cert]
+                full_command.append(server+data_doc['location'])
 
+                process = TransferProcess(full_command)
                 try:
-                    gfal_out = subprocess.check_output(full_command, stderr=subprocess.STDOUT, shell=True)
+                    process.run()
 
                 except subprocess.CalledProcessError as gfal_exec:
-                    self.log.error(gfal_exec.output.rstrip().decode('ascii'))
+                    self.log.error(gfal_exec.output)
                     self.log.error("Error: gfal-rm status = %d\n" % gfal_exec.returncode)
                     raise
 
-                gfal_out_ascii = gfal_out.rstrip().decode('ascii')
-                if "error" in gfal_out_ascii.lower(): # Some errors don't get caught above
-                    self.log.error(gfal_out_ascii)
-                    raise
-
-                else:
-                    self.log.info(gfal_out_ascii) # To print timing
+                if process.errors: # Some errors don't get caught above
+                    self.log.error('\n'.join(process.errors))
+                    raise IOError("gfal-rm reported errors")
 
             # Default POSIX removal        
             else:
@@ -228,7 +725,114 @@ class CompareChecksums(Task):
                     self.log.error('did not exist, notify run database.')
 
         if config.DATABASE_LOG == True:
-            resp = self.collection.update({'_id': self.run_doc['_id']},
-                                              {'$pull': {'data': data_doc}})
-            self.log.info('Removed from run database: %s' % data_doc['location'])
-            self.log.debug(resp)
+            self.writes.update({'_id': self.run_doc['_id']},
+                               {'$pull': {'data': data_doc}})
+            self.log.info('Removing from run database: %s' % data_doc['location'])
+
+
+class AuditChecksums(CompareChecksums):
+    """Re-read a share of the local files to catch bit rot
+
+    Every sweep verifies the files audited longest ago against their
+    checksum in the runs DB, up to a number of bytes per sweep, so that all
+    files are verified once per period without saturating the storage.  Set
+    'checksum_audit' in cax.json to enable, e.g.
+
+        {"state_file": "~/.cax_audit.sqlite", "period_days": 30,
+         "bytes_per_sweep": 100e9}
+    """
+
+    def __init__(self):
+        CompareChecksums.__init__(self)
+        self.candidates = []
+
+    def go(self, specify_run=None, restrict=None):
+        if config.get_checksum_audit() is None:
+            return
+        Task.go(self, specify_run, restrict)
+
+    def each_run(self):
+        # A single pass hands over the runs even when not auditing
+        if config.get_checksum_audit() is None:
+            return
+
+        # Do not overload this routine from checksum inheritance.
+        Task.each_run(self)
+
+    def each_location(self, data_doc):
+        if data_doc.get('host') != config.get_hostname() or \
+                data_doc['status'] != 'transferred':
+            return
+
+        if 'files' not in data_doc:
+            self.log.debug("No per-file checksums for %s" % data_doc['location'])
+            return
+
+        # Single files have themselves as only file
+        location = data_doc['location']
+        single_file = os.path.isfile(location)
+
+        for path, value in data_doc['files']:
+            path = location if single_file else os.path.join(location, path)
+            self.candidates.append((path, value, self.run_doc, data_doc))
+
+    def shutdown(self):
+        settings = config.get_checksum_audit()
+        candidates, self.candidates = self.candidates, []
+        if settings is None or not candidates:
+            return
+
+        audits = AuditLog(os.path.expanduser(settings['state_file']))
+        period = settings.get('period_days', 30) * 86400
+        budget = settings.get('bytes_per_sweep', 100e9)
+
+        last_audits = audits.last_audits()
+        now = time.time()
+
+        # Never audited files in random order, then the longest ago first
+        random.shuffle(candidates)
+        candidates.sort(key=lambda candidate: last_audits.get(candidate[0], 0))
+
+        spent = 0
+        # Candidates may come from copies of this task, each with its own run
+        for path, value, run_doc, data_doc in candidates:
+            if now - last_audits.get(path, 0) < period:
+                break
+
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+
+            # At least one file per sweep, however large
+            if spent and spent + size > budget:
+                break
+            spent += size
+
+            # Not file_digest: the checksum cache would not notice bit rot
+            try:
+                digest = compute_digests(path, ('sha512',))['sha512']
+            except OSError:
+                digest = None
+
+            if digest != value:
+                self.run_doc = run_doc
+                self.give_error("Audit found bad file %s, run %s" %
+                                (path, run_doc['number']))
+                if config.DATABASE_LOG:
+                    self.writes.update({'_id': run_doc['_id'],
+                                        'data': {'$elemMatch': {
+                                            'host': data_doc['host'],
+                                            'location': data_doc['location']}}},
+                                       {'$set': {'data.$.checksumproblem': True}})
+
+            audits.audited(path, now)
+            last_audits[path] = now
+
+        self.writes.flush()
+
+        covered = sum(1 for candidate in candidates
+                      if now - last_audits.get(candidate[0], 0) < period)
+        self.log.info("Audited within the last %d days: %d of %d files "
+                      "(%.1f%%)" % (period / 86400, covered, len(candidates),
+                                    100. * covered / len(candidates)))
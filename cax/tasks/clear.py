@@ -25,6 +25,11 @@ class RetryStalledTransfer(checksum.CompareChecksums):
     # Do not overload this routine from checksum inheritance.
     each_run = Task.each_run
 
+    def run_filter(self):
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'status': {'$nin': ['transferred',
+                                                            'verifying']}}}}
+
     def each_location(self, data_doc):
         if 'host' not in data_doc or data_doc['host'] != config.get_hostname():
             return  # Skip places where we can't locally access data
@@ -60,10 +65,27 @@ class RetryStalledTransfer(checksum.CompareChecksums):
 
         if difference > datetime.timedelta(hours=24):
             self.give_error("Transfer lasting more than 24 hours, retry.")
-            self.purge(data_doc, delete_data)
+            self.retry(data_doc, delete_data)
             
         elif data_doc["status"] == 'error' and data_doc['host'] != 'xe1t-datamanager':
             self.give_error("Transfer or process errored, retry.")
+            self.retry(data_doc, delete_data)
+
+    def retry(self, data_doc, delete_data):
+        """Leave the transfer to be resumed if some files are known to be
+        copied, otherwise start over.
+
+        A transfer left to resume for 24 hours is started over too.
+        """
+        if data_doc.get('manifest') and data_doc['status'] != 'resume':
+            self.log.info("Keeping %d copied files of %s to resume" %
+                          (len(data_doc['manifest']), data_doc['location']))
+            if config.DATABASE_LOG:
+                self.writes.update({'_id': self.run_doc['_id'],
+                                    'data': {'$elemMatch': data_doc}},
+                                   {'$set': {'data.$.status': 'resume',
+                                             'data.$.creation_time': datetime.datetime.utcnow()}})
+        else:
             self.purge(data_doc, delete_data)
 
 class RetryBadChecksumTransfer(checksum.CompareChecksums):
@@ -93,13 +115,27 @@ class RetryBadChecksumTransfer(checksum.CompareChecksums):
                             data_doc['type'], data_doc['pax_version']))
 
             if self.check(data_doc['type'], warn=False) > 1:
-                self.purge(data_doc)
+                bad_files = checksum.mismatched_files(data_doc,
+                                                      self.get_main_data_doc(**data_doc))
+
+                if bad_files and os.path.isdir(data_doc['location']):
+                    # Keep the good files, the next pull only fetches the others
+                    for path in bad_files:
+                        self.log.info("Deleting bad file %s of %s" % (path,
+                                      data_doc['location']))
+                        bad_file = os.path.join(data_doc['location'], path)
+                        if os.path.isfile(bad_file):
+                            os.remove(bad_file)
+                    self.purge(data_doc, delete_data=False)
+                else:
+                    self.purge(data_doc)
 
 
 class BufferPurger(checksum.CompareChecksums):
     """Purge buffer
 
     """
+    fields = ('start',)
 
     # Do not overload this routine from checksum inheritance.
     each_run = Task.each_run
@@ -196,6 +232,10 @@ class PurgeProcessed(checksum.CompareChecksums):
     # Do not overload this routine from checksum inheritance.
     each_run = Task.each_run
 
+    def run_filter(self):
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'type': 'processed'}}}
+
     def each_location(self, data_doc):
         """
         Check every location with data whether it should be purged.
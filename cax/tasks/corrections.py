@@ -34,6 +34,7 @@ class CorrectionBase(Task):
     key = 'not_set'
     collection_name = 'not_set'
     version = 'not_set'
+    fields = ('start', 'end', 'detector', 'processor.correction_versions')
 
     def __init__(self):
         self.correction_collection = config.mongo_collection(self.collection_name)
@@ -43,6 +44,16 @@ class CorrectionBase(Task):
             raise ValueError("You must set a correction collection_name attribute")
         Task.__init__(self)
 
+    def run_filter(self):
+        # Only ended runs without the latest correction version
+        cdoc = self.correction_collection.find_one(sort=(('calculation_time', -1), ))
+        if cdoc is None:
+            return None
+        version = cdoc.get('version', str(cdoc['calculation_time']))
+
+        return {'end': {'$exists': True},
+                'processor.correction_versions.' + self.__class__.__name__: {'$ne': version}}
+
     def each_run(self):
         if 'end' not in self.run_doc:
             # Run is still in progress, don't compute the correction
@@ -125,6 +136,7 @@ class AddGains(CorrectionBase):
     key = 'processor.DEFAULT.gains'
     collection_name = 'gains'
     correction_units = units.V  # should be 1
+    fields = CorrectionBase.fields + ('reader.self_trigger',)
 
     def evaluate(self):
         """Make an array of all PMT gains."""
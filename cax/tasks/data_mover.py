@@ -4,40 +4,65 @@ This is one of the key tasks of 'cax' because it's responsible for moving
 data between sites.  At present, it just does scp.
 """
 
+import copy
 import datetime
 import logging
 import os
 import time
 import shutil
-import scp
-from paramiko import SSHClient, util
+import tempfile
 
+import paramiko
 import pax
 
 from cax import config
-from cax.task import Task
+from cax.task import Task, TrackedCollection
+from cax.transfer import TransferScheduler, SFTPCopy, Manifest, TransferProcess
 from cax import qsub
 from cax.tasks.clear import BufferPurger
 
 from cax.tasks.tsm_mover import TSMclient
 from cax.tasks.rucio_mover import RucioBase, RucioRule, RucioDownload
-from cax.tasks.checksum import ChecksumMethods
+from cax.tasks import checksum
 
 import subprocess
 
+# Methods able to copy single files of a dataset, and so to resume a
+# transfer from its manifest.  See CopyBase.copy_dataset.
+RESUMABLE_METHODS = ('scp', 'rsync', 'gfal-copy')
+
 class CopyBase(Task):
+    """Plan transfers during the sweep, then run them all concurrently
 
-    def copy(self, datum_original, datum_destination, method, option_type, data_type):
+    Transfers are run by a TransferScheduler at shutdown, with the limits set
+    by 'transfer_slots' in cax.json.
+    """
+    # Purge check and Rucio meta data need more than the data locations
+    fields = ('start', 'detector', 'user', 'source.type',
+              'trigger.events_built')
+
+    def __init__(self):
+        # Transfers planned during the sweep, see run_transfer
+        self.planned = []
+        Task.__init__(self)
+
+    def copy(self, datum_original, datum_destination, method, option_type, data_type,
+             paths=None, on_file=None):
+        """Copy a dataset with the given method
+
+        paths and on_file are only supported by scp and rsync: only the files
+        at these paths are copied, and on_file is called with the path of
+        each file once copied.
+        """
 
         if option_type == 'upload':
-            config_destination = config.get_config(datum_destination['host'])
-            server = config_destination['hostname']
-            username = config_destination['username']
-
+            remote_host = datum_destination['host']
         else:
-            config_original = config.get_config(datum_original['host'])
-            server = config_original['hostname']
-            username = config_original['username']
+            remote_host = datum_original['host']
+
+        config_remote = config.get_config(remote_host)
+        server = config_remote['hostname']
+        username = config_remote['username']
 
         if config.nstream_settings() == None:
             nstreams = 1
@@ -51,10 +76,12 @@ class CopyBase(Task):
 
         # Determine method for remote site
         if method == 'scp':
-            self.copySCP(datum_original, datum_destination, server, username, option_type)
+            self.copySCP(datum_original, datum_destination, server, username, option_type,
+                         config.get_ssh_compress(remote_host), paths, on_file)
 
         elif method == 'rsync':
-            self.copyRSYNC(datum_original, datum_destination, server, username, option_type, data_type)
+            self.copyRSYNC(datum_original, datum_destination, server, username, option_type, data_type,
+                           paths, on_file)
 
         elif method == 'gfal-copy':
             self.copyGFAL(datum_original, datum_destination, server, option_type, nstreams, grid_cert)
@@ -80,11 +107,9 @@ class CopyBase(Task):
 
         # gfal-copy arguments:
         #   -n: number of streams (4 for now, but doesn't work on xe1t-datamanager so use lcg-cp instead)
-        command_options = "-b -D srmv2 " # Currently for resolving Midway address, may not be needed for other sites
-        command_options += "-n %d " % (nstreams)
-        command = "time lcg-cr "+command_options
-
-        status = -1
+        command = ['lcg-cr',
+                   '-b', '-D', 'srmv2', # Currently for resolving Midway address, may not be needed for other sites
+                   '-n', str(nstreams)]
 
         if option_type == 'upload':
             logging.info(option_type+": %s to %s" % (datum_original['location'],
@@ -103,17 +128,15 @@ class CopyBase(Task):
                     lfc_address = lfc_config['hostname']+lfc_config['dir_'+datum_original['type']]
 
                     full_command = command+ \
-                                   "-d "+server+datum_destination['location']+"/"+filename+" "+ \
-                                   "-l "+lfc_address+"/"+dataset+"/"+filename+" "+ \
-                                   "file://"+datum_original['location']+"/"+filename
-                    
-                    self.log.info(full_command)
+                                   ["-d", server+datum_destination['location']+"/"+filename,
+                                    "-l", lfc_address+"/"+dataset+"/"+filename,
+                                    "file://"+datum_original['location']+"/"+filename]
 
                     try:
-                        lcg_out = subprocess.check_output(full_command, stderr=subprocess.STDOUT, shell=True)
+                        TransferProcess(full_command).run()
 
                     except subprocess.CalledProcessError as lcg_exec:
-                        self.log.error(lcg_exec.output.rstrip().decode('ascii'))
+                        self.log.error(lcg_exec.output)
                         self.log.error("Error: lcg-cr status = %d\n" % lcg_exec.returncode)
                         raise
 
@@ -141,9 +164,10 @@ class CopyBase(Task):
         #   -t: timeout in seconds
         #   -K: specify checksum algorithm
         # --cert: path to initialized GRID certificate (voms-proxy-init  -voms xenon.biggrid.nl -valid 168:00 -out user_cert)
-        command = "time gfal-copy -v -f -r -p -t 32400 -K adler32 --cert %s -n %d " % (grid_cert, nstreams)
-
-        status = -1
+        command = ['gfal-copy', '-v', '-f', '-r', '-p', '-t', '32400', '-K', 'adler32',
+                   '-n', str(nstreams)]
+        if grid_cert:
+            command += ['--cert', grid_cert]
 
         if option_type == 'upload':
             logging.info(option_type+": %s to %s" % (datum_original['location'],
@@ -160,9 +184,9 @@ class CopyBase(Task):
                 config_original = config.get_config(datum_original['host'])
                 server_original = config_original['hostname']
                 full_command = command+ \
-                           server_original+datum_original['location']+" "+ \
-                           server+datum_destination['location'] #+" "+ \
-                           #lfc_address+"/"+dataset                  
+                           [server_original+datum_original['location'],
+                            server+datum_destination['location']] #+ \
+                           #[lfc_address+"/"+dataset]
 
             # Use SRM address instead of POSIX from Midway (to avoid worker nodes)
             #elif config.get_hostname() == 'midway-login1':
@@ -174,111 +198,227 @@ class CopyBase(Task):
            
             else:
                 full_command = command+ \
-                           "file://"+datum_original['location']+" "+ \
-                           server+datum_destination['location'] #+" "+ \
-                           #lfc_address+"/"+dataset                  
+                           ["file://"+datum_original['location'],
+                            server+datum_destination['location']] #+ \
+                           #[lfc_address+"/"+dataset]
 
         else: # download
             logging.info(option_type+": %s to %s" % (server+datum_original['location'],
                                                      datum_destination['location']))
  
             full_command = command+ \
-                           server+datum_original['location']+" "+ \
-                           "file://"+datum_destination['location']
-
-        self.log.info(full_command)
+                           [server+datum_original['location'],
+                            "file://"+datum_destination['location']]
 
+        # -v logs can be huge, only their end is kept
+        process = TransferProcess(full_command)
         try:
-            gfal_out = subprocess.check_output(full_command, stderr=subprocess.STDOUT, shell=True)
+            process.run()
 
         except subprocess.CalledProcessError as gfal_exec:
-            self.log.error(gfal_exec.output.rstrip().decode('ascii'))
+            self.log.error(gfal_exec.output)
             self.log.error("Error: gfal-copy status = %d\n" % gfal_exec.returncode)
             raise
 
-        gfal_out_ascii = gfal_out.rstrip().decode('ascii')
-        if "error" in gfal_out_ascii.lower(): # Some errors don't get caught above
-            self.log.error(gfal_out_ascii)
-            raise
-
-        else:
-            self.log.info(gfal_out_ascii) # To print timing
+        if process.errors: # Some errors don't get caught above
+            self.log.error('\n'.join(process.errors))
+            raise IOError("gfal-copy reported errors")
             
-    def copyRSYNC(self, datum_original, datum_destination, server, username, option_type, data_type):
+    def copyRSYNC(self, datum_original, datum_destination, server, username, option_type, data_type,
+                  paths=None, on_file=None):
         """Copy data via rsync function
+
+        With paths, only these files of the directory are copied.  rsync
+        then reports each file once copied, which is passed on to on_file.
         """
 
-        command = "time rsync -r --stats "
+        # Progress is printed all along, so that a stall can be told apart
+        # from a large file
+        command = ['rsync', '-r', '--stats', '--progress']
 
-        if data_type is 'raw':
-            command += "--append "
+        if data_type == 'raw':
+            command.append('--append')
 
-        status = -1
+        files_from = None
+        if paths is not None:
+            files_from = tempfile.NamedTemporaryFile('w', prefix='cax_rsync_',
+                                                     suffix='.txt')
+            files_from.write('\n'.join(paths) + '\n')
+            files_from.flush()
+
+            # Logged at the end of each file, with the bytes sent
+            command += ['--files-from=%s' % files_from.name,
+                        '--out-format=%n %b']
 
         if option_type == 'upload':
             logging.info(option_type+": %s to %s" % (datum_original['location'],
                                             server+datum_destination['location']))
 
-            full_command = command+ \
-                       datum_original['location']+" "+ \
-                       username+"@"+server+":"+os.path.dirname(datum_destination['location'])
+            if paths is None:
+                command += [datum_original['location'],
+                            username+"@"+server+":"+os.path.dirname(datum_destination['location'])]
+            else:
+                command += [datum_original['location']+"/",
+                            username+"@"+server+":"+datum_destination['location']+"/"]
 
         else: # download
             logging.info(option_type+": %s to %s" % (server+datum_original['location'],
                                                      datum_destination['location']))
 
-            full_command = command+ \
-                           username+"@"+server+":"+datum_original['location']+" "+ \
-                           os.path.dirname(datum_destination['location'])
+            if paths is None:
+                command += [username+"@"+server+":"+datum_original['location'],
+                            os.path.dirname(datum_destination['location'])]
+            else:
+                command += [username+"@"+server+":"+datum_original['location']+"/",
+                            datum_destination['location']+"/"]
 
-        self.log.info(full_command)
+        on_line = None
+        if paths is not None and on_file is not None:
+            on_line = self.rsync_copied(paths, on_file)
 
+        # --progress keeps printing, silence means rsync is stuck
+        process = TransferProcess(command, on_line, stall_timeout=None)
         try:
-            rsync_out = subprocess.check_output(full_command, stderr=subprocess.STDOUT, shell=True)
+            process.run()
 
         except subprocess.CalledProcessError as rsync_exec:
-            self.log.error(rsync_exec.output.rstrip().decode('ascii'))
+            self.log.error(rsync_exec.output)
             self.log.error("Error: rsync status = %d\n" % rsync_exec.returncode)
             raise
 
-        rsync_out_ascii = rsync_out.rstrip().decode('ascii')
-        if "error" in rsync_out_ascii.lower(): # Some errors don't get caught above
-            self.log.error(rsync_out_ascii)
-            raise
+        finally:
+            if files_from is not None:
+                files_from.close()
 
-        else:
-            self.log.info(rsync_out_ascii) # To print timing
+        if process.errors: # Some errors don't get caught above
+            self.log.error('\n'.join(process.errors))
+            raise IOError("rsync reported errors")
 
+    def rsync_copied(self, paths, on_file):
+        """Returns a handler of rsync output lines, passing the files rsync
+        reports as copied on to on_file"""
+        paths = set(paths)
 
-    def copySCP(self, datum_original, datum_destination, server, username, option_type):
-        """Copy data via SCP function
-        """
-        util.log_to_file('ssh.log')
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
+        def on_line(line):
+            # --out-format lines are the path and the bytes sent
+            path, _, sent = line.rpartition(' ')
+            if sent.isdigit() and path in paths:
+                paths.remove(path)
+                on_file(path)
 
-        logging.info("connection to %s" % server)
-        ssh.connect(server, 
-                    username=username,
-                    compress=True,
-                    timeout=60)
+        return on_line
 
-        # SCPCLient takes a paramiko transport as its only argument
-        client = scp.SCPClient(ssh.get_transport())
+    def copySCP(self, datum_original, datum_destination, server, username, option_type,
+                compress=True, paths=None, on_file=None):
+        """Copy data via SCP function
+
+        Files are sent in parallel over SFTP, on pooled SSH connections.  A
+        file cut short by an earlier attempt is resumed.
+        """
+        client = SFTPCopy(server, username, compress, on_file=on_file,
+                          **config.get_sftp_options())
 
         logging.info(option_type+": %s to %s" % (datum_original['location'],
                                                  datum_destination['location']))
-        
+
         if option_type == 'upload':
-            client.put(datum_original['location'],
-                       datum_destination['location'],
-                       recursive=True)
+            client.upload(datum_original['location'],
+                          datum_destination['location'], paths)
         else:
-            client.get(datum_original['location'],
-                       datum_destination['location'],
-                       recursive=True)
+            client.download(datum_original['location'],
+                            datum_destination['location'], paths)
+
+    def copy_dataset(self, datum_original, datum_destination, method, option_type,
+                     data_type, manifest):
+        """Copy the files of a dataset that are not in the manifest yet
+
+        Files are copied one at a time, or in parallel with scp, and added to
+        the manifest once done.  Downloaded files are checked against the
+        checksums of the source first.  Datasets are copied in one go if the
+        method cannot copy single files, or if the files of the source are
+        not known.
+        """
+        files = self.source_files(datum_original, option_type)
+        if method not in RESUMABLE_METHODS or files is None:
+            self.copy(datum_original, datum_destination, method, option_type, data_type)
+            return
 
-        client.close()
+        # A processed dataset is a single file, listed under its own name
+        single = len(files) == 1 and \
+            files[0][0] == os.path.basename(datum_original['location'])
+
+        def location(datum, path):
+            if single:
+                return datum['location']
+            return os.path.join(datum['location'], path)
+
+        missing = []
+        for path, digest in files:
+            if not manifest.complete(path, digest):
+                missing.append(path)
+            elif option_type == 'download' and \
+                    not os.path.isfile(location(datum_destination, path)):
+                missing.append(path)
+
+        expected = dict(files)
+        if len(missing) < len(files):
+            self.log.info("Resuming %s, %d of %d files left" %
+                          (datum_destination['location'], len(missing),
+                           len(files)))
+
+        def on_file(path):
+            if single:
+                path = files[0][0]
+
+            if option_type == 'download':
+                copied = location(datum_destination, path)
+                # Read again, a cached digest would hide a bad copy
+                digest = checksum.compute_digests(copied, ('sha512',))['sha512']
+                if digest != expected[path]:
+                    # Copy again from scratch next time
+                    os.remove(copied)
+                    raise IOError("Bad checksum for %s" % copied)
+
+            manifest.add(path, expected[path])
+
+        if method == 'scp' or (method == 'rsync' and not single):
+            self.copy(datum_original, datum_destination, method, option_type, data_type,
+                      ['' if single else path for path in missing], on_file)
+            return
+
+        for path in missing:
+            file_original = dict(datum_original,
+                                 location=location(datum_original, path))
+            file_destination = dict(datum_destination,
+                                    location=location(datum_destination, path))
+            if option_type == 'download':
+                os.makedirs(os.path.dirname(file_destination['location']),
+                            exist_ok=True)
+            self.copy(file_original, file_destination, method, option_type, data_type)
+            on_file(path)
+
+    def source_files(self, datum, option_type):
+        """Returns [path, digest] of the files of the data to copy
+
+        Data not checksummed yet is only listed, with the size of each file
+        standing in for its digest: hashing it here would read it all once
+        more before every attempt.  Returns None if the files cannot be known.
+        """
+        if 'files' in datum:
+            return datum['files']
+
+        # Not checksummed yet, only possible here
+        if option_type != 'upload':
+            return None
+
+        if os.path.isdir(datum['location']):
+            return [[os.path.relpath(f, datum['location']).replace(os.sep, '/'),
+                     'size:%d' % os.path.getsize(f)]
+                    for f in checksum.dataset_files(datum['location'])]
+        elif os.path.isfile(datum['location']):
+            return [[os.path.basename(datum['location']),
+                     'size:%d' % os.path.getsize(datum['location'])]]
+        return None
 
     def each_run(self):
         """Run over the requested data types according to the json config file"""
@@ -296,7 +436,7 @@ class CopyBase(Task):
     def do_possible_transfers(self,
                               option_type='upload',
                               data_type='raw'):
-        """Determine candidate transfers.
+        """Determine candidate transfers, they are run at shutdown.
         :param option_type: 'upload' or 'download'
          :type str
         :param data_type: 'raw' or 'processed'
@@ -318,11 +458,7 @@ class CopyBase(Task):
             self.log.info("Skip download that would be purged")
             return None, None
 
-        start = time.time()
-
         # For this run, where do we have transfer access?
-        datum_there = None
-        datum_here = None
         for remote_host in options:
             self.log.debug(remote_host)
 
@@ -343,40 +479,121 @@ class CopyBase(Task):
               self.log.info("Former upload of %s failed with error", datum_here['location'])
               self.log.info("[('Connection aborted.', BadStatusLine('',))] -> Delete runDB status and start again")
               
-              self.collection.update({'_id': self.run_doc['_id']},
-                                     {'$pull': {'data': datum_there}})
+              self.writes.update({'_id': self.run_doc['_id']},
+                                 {'$pull': {'data': datum_there}})
 
-            #Upload logic for everything exepct tape
-            if option_type == 'upload' and method != "tsm" and datum_here and (datum_there is None or                                                           datum_there['status'] == 'RSEreupload'):
-                self.copy_handshake(datum_here, remote_host, method, option_type, data_type)
-                break
+            datum = self.pending_transfer(option_type, method, datum_here,
+                                          datum_there)
+            if datum is None:
+                continue
 
-            # Download logic for everything exepct tape
-            if option_type == 'download' and datum_there and datum_here is None and method != "tsm":
-                self.copy_handshake(datum_there, config.get_hostname(), method, option_type, data_type)
+            if option_type == 'upload':
+                source, destination = config.get_hostname(), remote_host
+            else:
+                source, destination = remote_host, config.get_hostname()
+
+            # Older runs first, within the order of data_type in cax.json
+            priority = (self.data_types().index(data_type),
+                        self.run_doc.get('start', datetime.datetime.max),
+                        self.run_doc['number'])
+
+            self.log.debug("Planning %s of %s %s from %s to %s" %
+                           (option_type, data_type, self.run_doc['number'],
+                            source, destination))
+            self.planned.append((priority, source, destination,
+                                 self.run_transfer, self.run_doc['_id'],
+                                 data_type, remote_host))
+
+            # A single source is enough to download from
+            if option_type == 'download':
                 break
 
-            # Upload tsm:
-            if option_type == 'upload' and datum_here and datum_there is None and method == "tsm":
-                self.copy_tsm(datum_here, config.get_config(remote_host)['name'], method, option_type)
-                break
+    def data_types(self):
+        """Data types to transfer, in order of priority"""
+        return config.get_config(config.get_hostname())['data_type']
 
-            # Download tsm:
-            if option_type == 'download' and datum_there and datum_here is None and method == "tsm":
-                self.copy_tsm_download(datum_there, config.get_hostname(), method, option_type)
-                break
+    def pending_transfer(self, option_type, method, datum_here, datum_there):
+        """Returns the data location to copy, None if nothing to do"""
+        if option_type == 'upload' and datum_here:
+            if datum_there is None:
+                return datum_here
+
+            # Upload logic for everything except tape
+            if method != "tsm" and datum_there['status'] in ('RSEreupload',
+                                                             'resume'):
+                return datum_here
+
+        elif option_type == 'download' and datum_there:
+            if datum_here is None:
+                return datum_there
+
+            if method != "tsm" and datum_here['status'] == 'resume':
+                return datum_there
+
+        return None
+
+    def resumable_datum(self, datum_new):
+        """Returns the data location left to resume datum_new, if any"""
+        for datum in self.run_doc['data']:
+            if datum.get('status') == 'resume' and \
+                    all(datum.get(key) == datum_new[key]
+                        for key in ('type', 'host', 'location')):
+                return datum
+        return None
+
+    def run_transfer(self, run_id, data_type, remote_host):
+        """Do a planned transfer, on a copy of this task
+
+        The run is read again since the plan was made during the sweep, so a
+        transfer done or started meanwhile is not done twice.
+        """
+        worker = copy.copy(self)
+        worker.collection = TrackedCollection(self.collection.collection)
+
+        worker.run_doc = worker.collection.find_one({'_id': run_id},
+                                                    projection=self.projection())
+        if worker.run_doc is None:
+            return
+
+        option_type = self.option_type
+        method = config.get_config(remote_host)['method']
+
+        datum_here, datum_there = worker.local_data_finder(data_type,
+                                                           option_type,
+                                                           remote_host)
+        datum = worker.pending_transfer(option_type, method, datum_here,
+                                        datum_there)
+        if datum is None:
+            self.log.debug("Transfer of %s %s to %s no longer needed" %
+                           (data_type, worker.run_doc['number'], remote_host))
+            return
+
+        worker.start_transfer(datum, remote_host, method, option_type,
+                              data_type)
+
+    def start_transfer(self, datum, remote_host, method, option_type,
+                       data_type):
+        """Copy a data location to or from remote_host"""
+        start = time.time()
+
+        if method == "tsm":
+            if option_type == 'upload':
+                self.copy_tsm(datum, config.get_config(remote_host)['name'],
+                              method, option_type)
+            else:
+                self.copy_tsm_download(datum, config.get_hostname(), method,
+                                       option_type)
+        elif option_type == 'upload':
+            self.copy_handshake(datum, remote_host, method, option_type,
+                                data_type)
+        else:
+            self.copy_handshake(datum, config.get_hostname(), method,
+                                option_type, data_type)
+
+        dataset = datum['location'].split('/').pop()
+        elapsed = time.time() - start
+        self.log.info(method+" "+option_type+" dataset "+dataset+" took %d seconds" % elapsed)
 
-        dataset = None
-        if datum_there is not None:
-            dataset = datum_there['location'].split('/').pop()
-        elif datum_here is not None:
-            dataset = datum_here['location'].split('/').pop()
-
-        if dataset is not None: # Not sure why it does this sometimes
-            end = time.time()
-            elapsed = end - start
-            self.log.info(method+" "+option_type+" dataset "+dataset+" took %d seconds" % elapsed) 
-     
     def local_data_finder(self, data_type, option_type, remote_host):
         datum_here = None  # Information about data here
         datum_there = None  # Information about data there
@@ -443,6 +660,8 @@ class CopyBase(Task):
 
 
         if config.DATABASE_LOG == True:
+            # The race check below needs the run DB up to date
+            self.writes.flush()
             result = self.collection.update_one({'_id': self.run_doc['_id'],
                                                  },
                                    {'$push': {'data': datum_new}})
@@ -549,6 +768,10 @@ class CopyBase(Task):
         #Init the TSM client for tape backup from an extern class
         self.tsm = TSMclient()
 
+        #Digests of each file, computed once for all the steps below.  They
+        #verify the upload, so are not taken from the checksum cache.
+        digests = checksum.DigestHandle(cached=False)
+
         logging.info('Tape Backup to PDC STOCKHOLM')
         print( datum, destination, method, option_type)
 
@@ -587,7 +810,7 @@ class CopyBase(Task):
         checksum_pretest_list = []
         for i_file in files:
           f_path = os.path.join(raw_data_path, raw_data_filename, i_file)
-          pre_test_checksum = ChecksumMethods.get_crc32(self,f_path)
+          pre_test_checksum = digests.file_digest(f_path, 'crc32')
           checksum_pretest_list.append(pre_test_checksum)
           
         double_counts = set([x for x in checksum_pretest_list if checksum_pretest_list.count(x) > 1])
@@ -615,6 +838,8 @@ class CopyBase(Task):
         logging.info("new entry for rundb: %s", datum_new )
 
         if config.DATABASE_LOG == True:
+            # The race check below needs the run DB up to date
+            self.writes.flush()
             result = self.collection.update_one({'_id': self.run_doc['_id'],
                                                  },
                                    {'$push': {'data': datum_new}})
@@ -627,7 +852,7 @@ class CopyBase(Task):
         logging.info("Start tape upload")
 
         #Prepare a copy from raw data location to tsm location ( including renaming)
-        checksum_before_raw = self.tsm.get_checksum_folder( raw_data_path+raw_data_filename )
+        checksum_before_raw = self.tsm.get_checksum_folder( raw_data_path+raw_data_filename, digests )
         file_list = []
         for (dirpath, dirnames, filenames) in os.walk(raw_data_path+raw_data_filename):
           file_list.extend(filenames)
@@ -642,24 +867,8 @@ class CopyBase(Task):
           if not os.path.exists(path_new):
               shutil.copy2(path_old, path_new)
 
-        checksum_before_tsm = self.tsm.get_checksum_folder( raw_data_tsm + raw_data_filename )
-
-        if checksum_before_raw != checksum_before_tsm:
-          logging.info("Something went wrong during copy & rename")
-          if config.DATABASE_LOG:
-            self.collection.update({'_id' : self.run_doc['_id'],
-                                  'data': {
-                                        '$elemMatch': datum_new}},
-                                   {'$set': {'data.$.status': "error",
-                                             'data.$.location': "n/a",
-                                             'data.$.checksum': "n/a",
-                                             }
-                                   })
-
-          return
-        elif checksum_before_raw == checksum_before_tsm:
-          logging.info("Copy & rename: [succcessful] -> Checksums agree")
-
+        # A bad copy is caught below, comparing what tape gives back with
+        # the raw data, so the copies are not read here
 
         tsm_upload_result = self.tsm.upload( raw_data_tsm + raw_data_filename )
         logging.info("Number of uploaded files: %s", tsm_upload_result["tno_backedup"])
@@ -669,7 +878,7 @@ class CopyBase(Task):
         logging.info("Inspected amount of data: %s", tsm_upload_result["tno_bytes_inspected"])
         logging.info("Upload time: %s", tsm_upload_result["tno_data_transfer_time"])
         logging.info("Network transfer rate: %s", tsm_upload_result["tno_network_transfer_rate"])
-        logging.info("MD5 Hash (raw data): %s", checksum_before_tsm)
+        logging.info("MD5 Hash (raw data): %s", checksum_before_raw)
 
         test_download = os.path.join(raw_data_tsm, "tsm_verify_download")
         #Make sure that temp. download directory exists:
@@ -689,7 +898,7 @@ class CopyBase(Task):
         logging.info("MD5 Hash (raw data): %s", checksum_after)
 
         status = ""
-        if checksum_before_tsm == checksum_after and checksum_empty_dir != checksum_before_tsm and checksum_empty_dir != checksum_after:
+        if checksum_before_raw == checksum_after and checksum_empty_dir != checksum_before_raw and checksum_empty_dir != checksum_after:
           logging.info("Upload to tape: [succcessful]")
           status = "transferred"
         else:
@@ -697,7 +906,7 @@ class CopyBase(Task):
           status = "error"
         
         #Print a warning if the checksum crosscheck fails!
-        if checksum_empty_dir == checksum_before_tsm or checksum_empty_dir == checksum_after:
+        if checksum_empty_dir == checksum_before_raw or checksum_empty_dir == checksum_after:
           logging.info("Checksum test indicates an empty folder before or after the tape upload")
           logging.info("Check your raw data directory %s for files", raw_data_tsm + raw_data_filename)
         
@@ -706,14 +915,14 @@ class CopyBase(Task):
         shutil.rmtree(test_download + "/" + raw_data_filename)
 
         if config.DATABASE_LOG:
-          self.collection.update({'_id' : self.run_doc['_id'],
-                                  'data': {
-                                        '$elemMatch': datum_new}},
-                                   {'$set': {'data.$.status': status,
-                                             'data.$.location': raw_data_tsm + raw_data_filename,
-                                             'data.$.checksum': checksum_after,
-                                             }
-                                   })
+          self.writes.update({'_id' : self.run_doc['_id'],
+                              'data': {
+                                    '$elemMatch': datum_new}},
+                               {'$set': {'data.$.status': status,
+                                         'data.$.location': raw_data_tsm + raw_data_filename,
+                                         'data.$.checksum': checksum_after,
+                                         }
+                               })
 
         return 0
 
@@ -800,23 +1009,39 @@ class CopyBase(Task):
             datum_new['location'] = "NA"    #specify a not available path for the download destination
             
 
+        # A transfer that died, left to be resumed
+        resumed = self.resumable_datum(datum_new)
+
         if config.DATABASE_LOG == True:
-            result = self.collection.update_one({'_id': self.run_doc['_id'],
-                                                 },
-                                   {'$push': {'data': datum_new}})
+            # The race check below needs the run DB up to date
+            self.writes.flush()
+            if resumed is None:
+                result = self.collection.update_one({'_id': self.run_doc['_id'],
+                                                     },
+                                       {'$push': {'data': datum_new}})
+            else:
+                claim = {key: resumed[key] for key in ('type', 'host', 'location', 'status')}
+                result = self.collection.update_one({'_id': self.run_doc['_id'],
+                                                     'data': {'$elemMatch': claim}},
+                                       {'$set': {'data.$.status': datum_new['status'],
+                                                 'data.$.creation_time': datum_new['creation_time']}})
 
             if result.matched_count == 0:
                 self.log.error("Race condition!  Could not copy because another "
                                "process seemed to already start.")
                 return
 
+        manifest = Manifest(self.writes if config.DATABASE_LOG else None,
+                            self.run_doc['_id'], datum_new,
+                            resumed.get('manifest', []) if resumed else [])
+
         self.log.info('Starting '+method)
 
         try:  # try to copy
-            self.copy(datum, 
-                      datum_new, 
-                      method, 
-                      option_type, data_type)
+            self.copy_dataset(datum,
+                              datum_new,
+                              method,
+                              option_type, data_type, manifest)
             # Checksumming to follow on local site
             if method == 'scp' or method == 'rsync':
                 status = 'verifying'
@@ -827,7 +1052,7 @@ class CopyBase(Task):
                 status = 'verifying'
                 # TO DO: Manually copy checksum to DB entry here
 
-        except scp.SCPException as e:
+        except (paramiko.SSHException, IOError) as e:
             self.log.exception(e)
             status = 'error'
 
@@ -847,43 +1072,48 @@ class CopyBase(Task):
             logging.info("  * RSE: %s", self.rucio.get_rucio_info()['rse'] )
             logging.info("  * Preliminary rule information: %s", self.rucio.get_rucio_info()['rule_info'] )
             
-            self.collection.update({'_id' : self.run_doc['_id'],
-                                    'data': {
-                                    '$elemMatch': datum_new}},
-                                 {'$set': {
-                                      'data.$.status': self.rucio.get_rucio_info()['status'],
-                                      'data.$.location': self.rucio.get_rucio_info()['location'],
-                                      'data.$.checksum': self.rucio.get_rucio_info()['checksum'],
-                                      'data.$.rse': self.rucio.get_rucio_info()['rse'],
-                                      'data.$.rule_info': self.rucio.get_rucio_info()['rule_info']
-                                          }
-                                })
+            self.writes.update({'_id' : self.run_doc['_id'],
+                                'data': {
+                                '$elemMatch': datum_new}},
+                             {'$set': {
+                                  'data.$.status': self.rucio.get_rucio_info()['status'],
+                                  'data.$.location': self.rucio.get_rucio_info()['location'],
+                                  'data.$.checksum': self.rucio.get_rucio_info()['checksum'],
+                                  'data.$.rse': self.rucio.get_rucio_info()['rse'],
+                                  'data.$.rule_info': self.rucio.get_rucio_info()['rule_info']
+                                      }
+                            })
+            # RucioRule reads this entry back from the run DB
+            self.writes.flush()
           
           elif method == "rucio" and option_type == "download":
             logging.info("Following entries are added to the runDB:")
             logging.info("  * Status: %s", self.ruciodw.get_rucio_info()['status'] )
             logging.info("  * Location: %s", self.ruciodw.get_rucio_info()['location'] )
             
-            self.collection.update({'_id' : self.run_doc['_id'],
-                                    'data': {
-                                    '$elemMatch': datum_new}},
-                                 {'$set': {
-                                      'data.$.status': self.ruciodw.get_rucio_info()['status'],
-                                      'data.$.location': self.ruciodw.get_rucio_info()['location']
-                                          }
-                                })  
+            self.writes.update({'_id' : self.run_doc['_id'],
+                                'data': {
+                                '$elemMatch': datum_new}},
+                             {'$set': {
+                                  'data.$.status': self.ruciodw.get_rucio_info()['status'],
+                                  'data.$.location': self.ruciodw.get_rucio_info()['location']
+                                      }
+                            })  
 
               
           else:
           #Fill the data if method is not rucio
             if config.DATABASE_LOG:  
-              self.collection.update({'_id' : self.run_doc['_id'],
-                                    'data': {
-                                        '$elemMatch': datum_new}},
-                                   {'$set': {
-                                        'data.$.status': status
-                                            }
-                                   })
+              update = {'$set': {'data.$.status': status}}
+
+              # Only needed to resume the transfer
+              if status != 'error' and len(manifest):
+                  update['$unset'] = {'data.$.manifest': ''}
+
+              self.writes.update({'_id' : self.run_doc['_id'],
+                                'data': {
+                                    '$elemMatch': datum_new}},
+                               update)
         
 
         if method == "rucio" and option_type == "upload":
@@ -928,6 +1158,18 @@ class CopyBase(Task):
 
         logging.info("End of "+option_type+"\n")
 
+    def shutdown(self):
+        """Run the transfers planned during the sweep"""
+        planned, self.planned[:] = list(self.planned), []
+
+        scheduler = TransferScheduler(**config.get_transfer_slots())
+        for transfer in planned:
+            scheduler.add(*transfer)
+        try:
+            scheduler.run()
+        finally:
+            self.writes.flush()
+
 class CopyPush(CopyBase):
     """Copy data to there
 
@@ -935,6 +1177,11 @@ class CopyPush(CopyBase):
     site (including transferring), then copy data there."""
     option_type = 'upload'
 
+    def run_filter(self):
+        # Need a good copy here
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'status': 'transferred'}}}
+
 class CopyPull(CopyBase):
     """Copy data to here
 
@@ -942,3 +1189,12 @@ class CopyPull(CopyBase):
     """
     option_type = 'download'
 
+    def run_filter(self):
+        options = config.get_transfer_options(self.option_type)
+        if not options:
+            return None
+
+        # Need a good copy at one of the hosts we download from
+        return {'data': {'$elemMatch': {'host': {'$in': options},
+                                        'status': 'transferred'}}}
+
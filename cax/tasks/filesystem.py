@@ -14,6 +14,7 @@ from cax.task import Task
 
 class SetPermission(Task):
     """Set the correct permissions at the PDC in Stockholm"""
+    fields = ()
 
     def __init__(self):
 
@@ -36,6 +37,9 @@ class SetPermission(Task):
         self.hostname_config = config.get_config(config.get_hostname())
         self.hostname = config.get_hostname()
 
+    def run_filter(self):
+        return {'data.host': config.get_hostname()}
+
     def each_run(self):
         """Set ownership and permissons for files/folders"""
         for data_doc in self.run_doc['data']:
@@ -88,6 +92,7 @@ class RenameSingle(Task):
     This renames a file or folder then updates the run database to reflect it.
     This is an unsafe operation since it does not perform a new checksum.
     """
+    fields = ()
 
     def __init__(self, input, output):
         # Save filesnames to use
@@ -97,6 +102,10 @@ class RenameSingle(Task):
         # Perform base class initialization
         Task.__init__(self)
 
+    def run_filter(self):
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'location': self.input}}}
+
     def each_run(self):
         # For each data location, see if this filename in it
         for data_doc in self.run_doc['data']:
@@ -130,6 +139,7 @@ class RemoveSingle(Task):
 
     This notifies the run database.
     """
+    fields = ()
 
     def __init__(self, location):
         # Save filesnames to use
@@ -138,6 +148,10 @@ class RemoveSingle(Task):
         # Perform base class initialization
         Task.__init__(self)
 
+    def run_filter(self):
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'location': self.location}}}
+
     def each_run(self):
         # For each data location, see if this filename in it
         for data_doc in self.run_doc['data']:
@@ -168,6 +182,7 @@ class RemoveTSMEntry(Task):
 
     This notifies the run database.
     """
+    fields = ()
 
     def __init__(self, location):
         # Save filesnames to use
@@ -214,6 +229,7 @@ class FindStrays(Task):
 
     This notifies the run database.
     """
+    fields = ()
 
     locations = []
 
@@ -246,6 +262,7 @@ class StatusSingle(Task):
 
     This notifies the run database.
     """
+    fields = ()
 
     def __init__(self, node__, status__):
         # Save filesnames to use
@@ -4,18 +4,17 @@ Performs batch queue operations to run pax.
 """
 
 import datetime
-import hashlib
 import subprocess
 import sys
 import os
 from collections import defaultdict
 
 import pax
-import checksumdir
 from pymongo import ReturnDocument
 
 from cax import qsub, config
 from cax.task import Task
+from cax.tasks import checksum
 
 
 
@@ -114,8 +113,7 @@ def _process(name, in_location, host, pax_version, pax_hash,
     if config.DATABASE_LOG == True:
         collection.update(query, {'$set': {'data.$': datum}})
 
-    datum['checksum'] = checksumdir._filehash(datum['location'],
-                                              hashlib.sha512)
+    datum['checksum'] = checksum.file_digest(datum['location'], 'sha512')
     if verify():
         datum['status'] = 'transferred'
     else:
@@ -127,11 +125,31 @@ def _process(name, in_location, host, pax_version, pax_hash,
 
 class ProcessBatchQueue(Task):
     "Create and submit job submission script."
+    # Not the gains, only whether they are there matters: see run_filter
+    fields = ('tags', 'detector', 'processor.DEFAULT.drift_velocity_liquid',
+              'processor.DEFAULT.electron_lifetime_liquid',
+              'reader.ini.write_mode', 'trigger.events_built')
 
     def verify(self):
         """Verify processing worked"""
         return True  # yeah... TODO.
 
+    def run_filter(self):
+        # Raw data must be here, and the corrections set
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'type': 'raw',
+                                        'status': 'transferred'}},
+                'processor.DEFAULT.gains': {'$exists': True},
+                'processor.DEFAULT.drift_velocity_liquid': {'$exists': True},
+                'processor.DEFAULT.electron_lifetime_liquid': {'$exists': True}}
+
+    def has_gains(self):
+        """Whether the run has gains, without fetching them"""
+        return self.collection.find_one({'_id': self.run_doc['_id'],
+                                         'processor.DEFAULT.gains':
+                                             {'$exists': True}},
+                                        projection={'_id': True}) is not None
+
     def each_run(self):
         if self.has_tag('donotprocess'):
             self.log.debug("Do not process tag found, skip processing")
@@ -143,10 +161,9 @@ class ProcessBatchQueue(Task):
             return
 
         processing_parameters = self.run_doc['processor']['DEFAULT']
-        if 'gains' not in processing_parameters or \
-            'drift_velocity_liquid' not in processing_parameters or \
+        if 'drift_velocity_liquid' not in processing_parameters or \
             'electron_lifetime_liquid' not in processing_parameters:
-            self.log.info("gains or e-lifetime not in run_doc, skip processing")
+            self.log.info("drift velocity or e-lifetime not in run_doc, skip processing")
             return
 
         thishost = config.get_hostname()
@@ -177,6 +194,12 @@ class ProcessBatchQueue(Task):
             self.log.debug("Skipping %s with 0 events", self.run_doc['name'])
             return
 
+        # Only checked now, as a single pass also hands over runs outside
+        # run_filter
+        if not self.has_gains():
+            self.log.info("gains not in run_doc, skip processing")
+            return
+
         # Specify number of cores for pax multiprocess
         if events < 1000:
             # Reduce to 1 CPU for small number of events (sometimes pax stalls
@@ -216,6 +239,9 @@ class ProcessBatchQueue(Task):
                      self.run_doc['detector'],
                      ncpus)
 
+            # _process notified the run DB through its own connection
+            self.collection.modified = True
+
 
     def local_data_finder(self, thishost, versions):
         have_processed = defaultdict(bool)
@@ -62,11 +62,19 @@ def _process_hax(name, in_location, host, pax_version,
 
 class ProcessBatchQueueHax(Task):
     "Create and submit job submission script."
+    fields = ('detector',)
 
     def verify(self):
         """Verify processing worked"""
         return True  # yeah... TODO.
 
+    def run_filter(self):
+        # Processed data must be here
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'type': 'processed',
+                                        'status': 'transferred',
+                                        'pax_version': 'v%s' % pax.__version__}}}
+
     def each_run(self):
 
         thishost = config.get_hostname()
@@ -23,7 +23,6 @@ import time
 import tarfile
 import copy
 import shutil
-import checksumdir
 import tempfile
 
 import scp
@@ -31,6 +30,7 @@ from paramiko import SSHClient, util
 
 from cax import config
 from cax.task import Task
+from cax.tasks import checksum
 
 
 
@@ -99,8 +99,15 @@ class TSMclient(Task):
         
         return stdout_value, stderr_value
     
-    def get_checksum_folder( self, raw_data_location ):
-        return checksumdir.dirhash(raw_data_location, 'sha512')
+    def get_checksum_folder( self, raw_data_location, digests=None ):
+        """sha512 of a folder, reusing the digests of a checksum.DigestHandle
+
+        This verifies data, e.g. after a restore, so files are read again
+        rather than taken from the checksum cache.
+        """
+        if digests is not None:
+            return digests.dirhash(raw_data_location, 'sha512')
+        return checksum.dirhash(raw_data_location, 'sha512', cached=False)
     
     def get_checksum_list(self, raw_data_location):
         """Get a dictionary with filenames and their checksums"""
@@ -306,6 +313,7 @@ class AddTSMChecksum(Task):
        and add the checksum to the runDB.
        (Only in case the checksum is not yet added)
     """
+    fields = ()
     
     def variables(self):
         self.checksum_xe1t = 'no_checksum_xe1tdatam'
@@ -0,0 +1,610 @@
+"""Machinery shared by the data transfer tasks
+
+The TransferScheduler runs the transfers planned during a sweep concurrently,
+within limits on the number of transfers per destination and per link.
+
+SSH connections are pooled per host, see ssh_transport().  Authenticated
+transports are kept alive between runs and each SCP or SFTP session is a
+channel of its own on the shared transport.
+
+SFTPCopy copies the files of a dataset over several SFTP channels at once,
+resuming and retrying each file on its own.
+
+A Manifest lists the files of an in-flight transfer known to be complete, so
+that a retry only copies the others.
+
+TransferProcess runs command line transfer tools (rsync, gfal-copy, ...),
+following their output as it comes rather than once they exit.
+"""
+
+import concurrent.futures
+import logging
+import os
+import re
+import selectors
+import signal
+import stat
+import subprocess
+import threading
+import time
+from collections import defaultdict, deque
+
+import paramiko
+
+from cax import config
+
+# Seconds between keepalive packets of pooled SSH transports
+SSH_KEEPALIVE = 60
+
+# Bytes per SFTP read or write of SFTPCopy
+SFTP_BLOCKSIZE = 1024 * 1024
+
+# Seconds a transfer tool streaming its progress (rsync --progress) may print
+# nothing before it is killed, can be overridden per host with
+# 'stall_timeout' in cax.json
+STALL_TIMEOUT = 3600
+
+# Lines of output of a transfer tool kept for error messages
+OUTPUT_LINES = 200
+
+# Longest line of output of a transfer tool, longer ones are split
+MAX_LINE = 64 * 1024
+
+# Progress printed by transfer tools, e.g. '  1,048,576  45%   10.50MB/s'
+PERCENT = re.compile(r'(\d+(?:\.\d+)?)%')
+RATE = re.compile(r'(\d+(?:\.\d+)?\s*[kKMGT]?i?B/s)')
+
+# Pooled SSH clients, see ssh_transport()
+_SSH_CLIENTS = {}
+_SSH_PID = None
+_SSH_LOCK = threading.Lock()
+
+
+class TransferScheduler:
+    """Run transfers concurrently, highest priority first
+
+    A transfer goes from a source host to a destination host.  At most
+    max_transfers run at once, per_destination to the same destination and
+    per_link between the same two hosts.  A transfer waiting for its link
+    does not hold up the transfers behind it.
+    """
+
+    def __init__(self, max_transfers=1, per_destination=1, per_link=1):
+        self.max_transfers = max_transfers
+        self.per_destination = per_destination
+        self.per_link = per_link
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.pending = []
+        self.lock = threading.Condition()
+
+    def add(self, priority, source, destination, function, *args):
+        """Plan a transfer, lower priority values go first"""
+        with self.lock:
+            self.pending.append((priority, len(self.pending), source,
+                                 destination, function, args))
+
+    def run(self):
+        """Run all planned transfers, returns once they are done"""
+        with self.lock:
+            pending, self.pending = sorted(self.pending), []
+
+        if not pending:
+            return
+
+        self.log.info("Running %d transfers" % len(pending))
+
+        running = [0]
+        by_destination = defaultdict(int)
+        by_link = defaultdict(int)
+
+        def startable():
+            """Index of the first pending transfer allowed to start"""
+            if running[0] >= self.max_transfers:
+                return None
+            for i, (priority, n, source, destination, function,
+                    args) in enumerate(pending):
+                if by_destination[destination] < self.per_destination and \
+                        by_link[(source, destination)] < self.per_link:
+                    return i
+            return None
+
+        def transfer(source, destination, function, args):
+            try:
+                function(*args)
+            except Exception:
+                self.log.exception("Transfer from %s to %s failed" %
+                                   (source, destination))
+            finally:
+                with self.lock:
+                    running[0] -= 1
+                    by_destination[destination] -= 1
+                    by_link[(source, destination)] -= 1
+                    self.lock.notify_all()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_transfers) as pool:
+            while pending:
+                with self.lock:
+                    i = startable()
+                    while i is None:
+                        self.lock.wait()
+                        i = startable()
+
+                    priority, n, source, destination, function, args = \
+                        pending.pop(i)
+                    running[0] += 1
+                    by_destination[destination] += 1
+                    by_link[(source, destination)] += 1
+
+                pool.submit(transfer, source, destination, function, args)
+
+
+def ssh_transport(server, username, compress=False, timeout=60, slot=0):
+    """Returns the SSH transport shared within this process to this server
+
+    A transport that died is replaced by a new connection.  Open a channel
+    per session on it, e.g. scp.SCPClient(transport), and close that rather
+    than the transport.  Different slots get different connections, as a
+    single TCP connection rarely fills a long distance link.  Transports are
+    not fork safe, so a forked child makes its own.
+    """
+    global _SSH_PID
+
+    key = (server, username, compress, slot)
+
+    with _SSH_LOCK:
+        if _SSH_PID != os.getpid():
+            # Inherited from the parent, leave those alone
+            if _SSH_PID is None:
+                paramiko.util.log_to_file('ssh.log')
+            _SSH_PID = os.getpid()
+            _SSH_CLIENTS.clear()
+
+        client = _SSH_CLIENTS.get(key)
+        if client is not None:
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                return transport
+
+            client.close()
+
+        logging.info("connection to %s (compression %s)" %
+                     (server, 'on' if compress else 'off'))
+
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.connect(server,
+                       username=username,
+                       compress=compress,
+                       timeout=timeout)
+
+        transport = client.get_transport()
+        transport.set_keepalive(SSH_KEEPALIVE)
+
+        _SSH_CLIENTS[key] = client
+        return transport
+
+
+def close_ssh_transports():
+    """Close all pooled SSH connections of this process"""
+    with _SSH_LOCK:
+        if _SSH_PID == os.getpid():
+            for client in _SSH_CLIENTS.values():
+                client.close()
+        _SSH_CLIENTS.clear()
+
+
+class SFTPCopy:
+    """Copy a file or a directory tree over several SFTP channels at once
+
+    Files are spread over a number of worker threads, each file with its own
+    channel.  The channels take turns on a number of SSH connections, as
+    one connection rarely fills a long distance link.  A partial file at
+    the destination is resumed from where it stopped, one of the same size
+    is assumed complete.  A failed file is retried on its own.
+
+    progress, if given, is called with the relative path, bytes copied and
+    size of a file after every block.  on_file, if given, is called with the
+    relative path of every file once copied.
+    """
+
+    def __init__(self, server, username, compress=False, workers=4,
+                 connections=1, retries=3, progress=None, on_file=None):
+        self.server = server
+        self.username = username
+        self.compress = compress
+        self.workers = workers
+        self.connections = connections
+        self.retries = retries
+        self.progress = progress
+        self.on_file = on_file
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def open_sftp(self, slot=0):
+        """Returns a new SFTP session on a pooled connection"""
+        transport = ssh_transport(self.server, self.username, self.compress,
+                                  slot=slot % self.connections)
+        return paramiko.SFTPClient.from_transport(transport)
+
+    def upload(self, source, destination, paths=None):
+        """Copy a local file or directory to the server
+
+        paths restricts the copy to these files, relative to source.
+        """
+        files = list_local(source)
+        if paths is not None:
+            paths = set(paths)
+            files = [file for file in files if file[0] in paths]
+
+        sftp = self.open_sftp()
+        try:
+            for directory in sorted({os.path.dirname(join(destination, path))
+                                     for path, size in files}):
+                make_remote_dirs(sftp, directory)
+        finally:
+            sftp.close()
+
+        self.copy_files('upload', source, destination, files)
+
+    def download(self, source, destination, paths=None):
+        """Copy a file or directory of the server here
+
+        paths restricts the copy to these files, relative to source.
+        """
+        sftp = self.open_sftp()
+        try:
+            if paths is None:
+                files = list_remote(sftp, source)
+            else:
+                files = [(path, sftp.stat(join(source, path)).st_size)
+                         for path in paths]
+        finally:
+            sftp.close()
+
+        for directory in {os.path.dirname(join(destination, path))
+                          for path, size in files}:
+            os.makedirs(directory, exist_ok=True)
+
+        self.copy_files('download', source, destination, files)
+
+    def copy_files(self, option_type, source, destination, files):
+        """Copy (relative path, size) files, raises if any could not be"""
+        self.log.info("%s of %d files from %s to %s with %d workers" %
+                      (option_type, len(files), source, destination,
+                       self.workers))
+
+        # Largest first, so that no big file is left alone at the end
+        files = sorted(files, key=lambda file: file[1], reverse=True)
+
+        finished = []
+        lock = threading.Lock()
+
+        def count(future):
+            with lock:
+                finished.append(future)
+                self.log.info("%d of %d files of %s done" %
+                              (len(finished), len(files), source))
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as pool:
+            futures = {}
+            for i, (path, size) in enumerate(files):
+                future = pool.submit(self.copy_file, option_type,
+                                     join(source, path),
+                                     join(destination, path), path, size, i)
+                future.add_done_callback(count)
+                futures[future] = path
+
+        failed = [futures[future] for future in futures
+                  if future.exception() is not None]
+        if failed:
+            raise IOError("Could not copy %d of %d files of %s: %s" %
+                          (len(failed), len(files), source,
+                           ', '.join(sorted(failed))))
+
+    def copy_file(self, option_type, source, destination, path, size,
+                  slot=0):
+        """Copy a single file, resuming and retrying as needed"""
+        for attempt in range(1, self.retries + 1):
+            try:
+                sftp = self.open_sftp(slot)
+                try:
+                    copied = self.resume(sftp, option_type, source,
+                                         destination, path, size)
+                finally:
+                    sftp.close()
+                break
+            except (IOError, OSError, EOFError,
+                    paramiko.SSHException) as e:
+                if attempt == self.retries:
+                    self.log.error("Giving up on %s after %d attempts: %s" %
+                                   (path, attempt, e))
+                    raise
+                self.log.warning("Attempt %d of %s failed, retrying: %s" %
+                                 (attempt, path, e))
+                time.sleep(attempt)
+
+        if self.on_file is not None:
+            self.on_file(path)
+        return copied
+
+    def resume(self, sftp, option_type, source, destination, path, size):
+        """Copy what is missing of a file, returns the bytes copied"""
+        if option_type == 'upload':
+            open_source, open_destination = open, sftp.open
+            stat_destination = sftp.stat
+        else:
+            open_source, open_destination = sftp.open, open
+            stat_destination = os.stat
+
+        try:
+            done = stat_destination(destination).st_size
+        except (IOError, OSError):
+            done = None
+
+        if done == size:
+            self.log.debug("%s already copied" % path)
+            return 0
+        if done is None or done > size:
+            # Missing, or not the same file
+            done = 0
+
+        start = time.time()
+        with open_source(source, 'rb') as f_in, \
+                open_destination(destination, 'r+b' if done else 'wb') as f_out:
+            if option_type == 'upload':
+                # Do not wait for each write to be acknowledged
+                f_out.set_pipelined(True)
+            f_in.seek(done)
+            f_out.seek(done)
+            if option_type == 'download':
+                f_in.prefetch(size)
+
+            copied = 0
+            while True:
+                block = f_in.read(SFTP_BLOCKSIZE)
+                if not block:
+                    break
+                f_out.write(block)
+                copied += len(block)
+                if self.progress is not None:
+                    self.progress(path, done + copied, size)
+
+        if done + copied != size:
+            raise IOError("%s is %d bytes, copied %d" % (path, size,
+                                                          done + copied))
+
+        elapsed = max(time.time() - start, 1e-6)
+        self.log.debug("Copied %s%s, %.1f MB/s" %
+                       (path, ' (resumed)' if done else '',
+                        copied / elapsed / 1e6))
+        return copied
+
+
+def join(location, path):
+    """Location of a file of a dataset, path is '' for a single file"""
+    if not path:
+        return location
+    return location.rstrip('/') + '/' + path
+
+
+def list_local(location):
+    """Returns (relative path, size) of the files of a local dataset"""
+    if not os.path.isdir(location):
+        return [('', os.path.getsize(location))]
+
+    files = []
+    for root, dirs, filenames in os.walk(location):
+        for filename in filenames:
+            full_path = os.path.join(root, filename)
+            files.append((os.path.relpath(full_path, location),
+                          os.path.getsize(full_path)))
+    return files
+
+
+def list_remote(sftp, location, path=''):
+    """Returns (relative path, size) of the files of a remote dataset"""
+    attributes = sftp.stat(join(location, path))
+    if not stat.S_ISDIR(attributes.st_mode):
+        return [(path, attributes.st_size)]
+
+    files = []
+    for entry in sftp.listdir_attr(join(location, path)):
+        files.extend(list_remote(sftp, location,
+                                 join(path, entry.filename) if path
+                                 else entry.filename))
+    return files
+
+
+def make_remote_dirs(sftp, location):
+    """Like os.makedirs(location, exist_ok=True) over SFTP"""
+    try:
+        if stat.S_ISDIR(sftp.stat(location).st_mode):
+            return
+    except IOError:
+        pass
+
+    parent = os.path.dirname(location.rstrip('/'))
+    if parent and parent != location:
+        make_remote_dirs(sftp, parent)
+    sftp.mkdir(location)
+
+
+class Manifest:
+    """Files of an in-flight transfer known to be complete
+
+    The manifest is kept in the run DB with the data location being written,
+    as a list of [path, digest] like its 'files' once checksummed.  Paths are
+    relative to the dataset, digests are the sha512 of the source files, or
+    their size if the source was not checksummed yet.
+    Each file is written to the run DB as soon as it is added, so the
+    manifest outlives a transfer that dies.
+    """
+
+    def __init__(self, writes, run_id, datum, entries=()):
+        self.writes = writes
+        self.run_id = run_id
+        self.datum = datum
+        self.entries = dict(entries)
+        self.lock = threading.Lock()
+
+    def complete(self, path, digest):
+        """Whether this version of the file was copied"""
+        with self.lock:
+            return self.entries.get(path) == digest
+
+    def add(self, path, digest):
+        """Record a file as copied"""
+        with self.lock:
+            self.entries[path] = digest
+
+        if self.writes is None:
+            return
+
+        self.writes.update({'_id': self.run_id,
+                            'data': {'$elemMatch': self.datum}},
+                           {'$push': {'data.$.manifest': [path, digest]}})
+        self.writes.flush()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TransferProcess:
+    """Run a transfer tool, following its output as it comes
+
+    The command is an argument list, no shell is involved.  Output lines
+    (split on carriage returns too, as used by progress bars) are logged at
+    debug level and passed to on_line.  Only the last max_lines are kept, as
+    are the last lines mentioning an error.  Progress and throughput found in
+    the output are logged every progress_interval seconds.
+
+    A tool streaming its progress can be killed once it prints nothing for
+    stall_timeout seconds, None being 'stall_timeout' in cax.json or
+    STALL_TIMEOUT.  By default (0) it is never killed: gfal-copy and lcg-cr
+    print nothing while their output is a pipe, and have a timeout of their
+    own.
+    """
+
+    def __init__(self, argv, on_line=None, stall_timeout=0,
+                 max_lines=OUTPUT_LINES, progress_interval=60):
+        if stall_timeout is None:
+            stall_timeout = config.get_stall_timeout()
+            if stall_timeout is None:
+                stall_timeout = STALL_TIMEOUT
+
+        self.argv = [str(arg) for arg in argv]
+        self.on_line = on_line
+        self.stall_timeout = stall_timeout
+        self.progress_interval = progress_interval
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.lines = deque(maxlen=max_lines)
+        self.errors = deque(maxlen=max_lines)
+        self.percent = None
+        self.rate = None
+        self.last_progress_log = None
+
+    def run(self):
+        """Run the tool to its end, returns the last lines of its output
+
+        Raises subprocess.CalledProcessError if it failed and
+        subprocess.TimeoutExpired if it stalled.
+        """
+        self.log.info(' '.join(self.argv))
+        start = self.last_progress_log = time.time()
+
+        # In a session of its own, so that helpers like the ssh of rsync
+        # can be killed along
+        process = subprocess.Popen(self.argv, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+        try:
+            self.follow(process)
+            returncode = process.wait()
+        finally:
+            # Stalled, or on_line raised
+            if process.poll() is None:
+                self.log.warning("Killing %s" % self.argv[0])
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.wait()
+            process.stdout.close()
+
+        self.log.info("%s took %d seconds" % (self.argv[0],
+                                              time.time() - start))
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.argv,
+                                                output=self.output())
+        return self.output()
+
+    def follow(self, process):
+        """Read the output of the process until it closes it"""
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ)
+        fd = process.stdout.fileno()
+
+        partial = b''
+        last_output = time.time()
+        try:
+            while True:
+                timeout = None
+                if self.stall_timeout:
+                    timeout = last_output + self.stall_timeout - time.time()
+                    if timeout <= 0:
+                        raise subprocess.TimeoutExpired(self.argv,
+                                                        self.stall_timeout,
+                                                        output=self.output())
+
+                if not selector.select(timeout):
+                    continue
+
+                data = os.read(fd, MAX_LINE)
+                if not data:
+                    break
+                last_output = time.time()
+
+                lines = re.split(b'[\r\n]', partial + data)
+                partial = lines.pop()
+                if len(partial) > MAX_LINE:
+                    lines.append(partial)
+                    partial = b''
+
+                for line in lines:
+                    if line:
+                        self.line(line.decode('utf-8', 'replace'))
+        finally:
+            selector.close()
+
+        if partial:
+            self.line(partial.decode('utf-8', 'replace'))
+
+    def line(self, line):
+        """Handle a line of output"""
+        self.log.debug(line)
+        self.lines.append(line)
+        if 'error' in line.lower():
+            self.errors.append(line)
+
+        percent = PERCENT.search(line)
+        rate = RATE.search(line)
+        if percent or rate:
+            self.percent = percent.group(1) if percent else self.percent
+            self.rate = rate.group(1) if rate else self.rate
+
+            if time.time() - self.last_progress_log > self.progress_interval:
+                self.last_progress_log = time.time()
+                self.log.info("%s: %s%% at %s" % (self.argv[0],
+                                                  self.percent or '?',
+                                                  self.rate or '?'))
+
+        if self.on_line is not None:
+            self.on_line(line)
+
+    def output(self):
+        """The last lines of output"""
+        return '\n'.join(self.lines)
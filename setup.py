@@ -57,8 +57,11 @@ setup(
             'caxer = cax.main:main',  # For uniformity with paxer
             'cax-process = cax.tasks.process:main',
             'cax-mv = cax.main:move',
+            'cax-checksum = cax.main:checksum_location',
             'cax-rm = cax.main:remove',
             'cax-stray = cax.main:stray',
+            'cax-index = cax.main:index',
+            'cax-benchmark = cax.main:run_benchmark',
             'cax-status = cax.main:status',
             'massive-tsm = cax.main:massive_tsmclient',
             'cax-tsm-remove = cax.main:remove_from_tsm',
@@ -0,0 +1,30 @@
+"""Checksum benchmarks for pytest-benchmark
+
+Run with e.g. pytest tests/test_benchmark.py --benchmark-json=out.json, or
+use cax-benchmark without pytest.
+"""
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from cax import benchmark as cax_benchmark
+
+
+@pytest.fixture(scope='module')
+def dataset(tmpdir_factory):
+    """A raw-like dataset of 8 files of 4 MB"""
+    return cax_benchmark.make_dataset(str(tmpdir_factory.mktemp('benchmark').join('raw')),
+                                      n_files=8, file_size=4 * 1024 * 1024)
+
+
+@pytest.mark.parametrize('name', sorted(cax_benchmark.checksum_paths()))
+def test_checksum_path(benchmark, dataset, name):
+    benchmark(cax_benchmark.checksum_paths()[name], dataset)
+
+
+@pytest.mark.parametrize('blocksize', cax_benchmark.BLOCKSIZES)
+def test_digests(benchmark, dataset, blocksize):
+    from cax.tasks import checksum
+
+    path = checksum.dataset_files(dataset)[0]
+    benchmark(checksum.compute_digests, path, checksum.ALGORITHMS, blocksize)
@@ -33,9 +33,197 @@ def test_checksum(lone_run_collection):
     if run_status == 'verifying':
         # AddChecksum should now have added a checksum
         assert 'checksum' in data_doc()
+        assert [path for path, value in data_doc()['files']] == ['example_data.txt']
+        assert 'merkle_root' in data_doc()
 
     else:
         # AddChecksum currently does nothing if the status isn't verifying
         # (although there is a lot of code that  for status != verifying, this is all unreachable
         # due to a status check at the top, which was probably added later...)
         assert 'checksum' not in data_doc()
+
+
+def test_batched_fetch(lone_run_collection):
+    """Runs are fetched in batches but still visited once each, newest first.
+    """
+    from datetime import datetime, timedelta
+    from cax.task import Task
+
+    for number in range(2, 6):
+        lone_run_collection.insert_one({'number': number,
+                                        'start': datetime.now() + timedelta(hours=number),
+                                        'data': []})
+
+    class NumberingTask(Task):
+        batch_size = 2
+
+        def __init__(self):
+            Task.__init__(self)
+            self.numbers = []
+
+        def each_run(self):
+            self.numbers.append(self.run_doc['number'])
+
+    t = NumberingTask()
+    t.go()
+    assert t.numbers == [5, 4, 3, 2, 1]
+
+
+def test_parallel_runs(lone_run_collection):
+    """Runs are handled concurrently when a task has several workers.
+    """
+    import threading
+    import time
+    from datetime import datetime
+    from cax.task import Task
+
+    for number in range(2, 7):
+        lone_run_collection.insert_one({'number': number,
+                                        'start': datetime.now(),
+                                        'data': []})
+
+    class SlowTask(Task):
+        workers = 3
+        write_batch_size = 2
+
+        def __init__(self):
+            Task.__init__(self)
+            self.numbers = []
+            self.threads = set()
+
+        def each_run(self):
+            number = self.run_doc['number']
+            time.sleep(0.05)
+            # Each worker has its own run document
+            assert self.run_doc['number'] == number
+            self.numbers.append(number)
+            self.threads.add(threading.current_thread().name)
+            self.writes.update({'_id': self.run_doc['_id']},
+                               {'$set': {'handled': True}})
+
+    t = SlowTask()
+    t.go()
+    assert sorted(t.numbers) == [1, 2, 3, 4, 5, 6]
+    assert len(t.threads) > 1
+
+    # Writes of all workers went through the shared buffer
+    assert lone_run_collection.count_documents({'handled': True}) == 6
+
+
+def test_projection(lone_run_collection):
+    """Tasks only receive the run document fields they declare.
+    """
+    from cax.task import Task
+    from cax.sweep import Dispatcher
+
+    class StartTask(Task):
+        fields = ('start',)
+
+        def each_run(self):
+            self.keys = set(self.run_doc.keys())
+
+    t = StartTask()
+    t.go()
+    assert t.keys == {'_id', 'number', 'data', 'start'}
+
+    class ReaderTask(Task):
+        fields = ('reader', 'reader.ini')
+
+    assert Dispatcher([t, ReaderTask()]).projection() == ['data', 'name', 'number',
+                                                          'reader', 'start']
+    assert Dispatcher([t, Task()]).projection() is None
+
+
+def test_run_filter(lone_run_collection):
+    """Only runs matching the task's run filter are handed to it.
+    """
+    from cax.tasks.checksum import AddChecksum
+
+    class CountingChecksum(AddChecksum):
+        runs_seen = 0
+
+        def each_run(self):
+            self.runs_seen += 1
+
+    t = CountingChecksum()
+    t.go()
+    status = lone_run_collection.find_one({})['data'][0]['status']
+    assert t.runs_seen == (1 if status == 'verifying' else 0)
+
+
+def test_write_buffer(lone_run_collection):
+    """Buffered updates reach the runs DB in order, once flushed.
+    """
+    from cax.task import Task
+
+    class StatusTask(Task):
+        write_batch_size = 3
+
+        def each_location(self, data_doc):
+            for status in ('a', 'b'):
+                self.writes.update({'_id': self.run_doc['_id']},
+                                   {'$set': {'status': status}})
+
+            # Not sent yet
+            assert 'status' not in lone_run_collection.find_one({})
+
+    t = StatusTask()
+    t.go()
+    assert lone_run_collection.find_one({})['status'] == 'b'
+
+    # A full buffer is sent right away
+    for status in ('c', 'd', 'e'):
+        t.writes.update({}, {'$set': {'status': status}})
+    assert not t.writes.requests
+    assert lone_run_collection.find_one({})['status'] == 'e'
+
+
+def test_write_buffer_error(lone_run_collection):
+    """Updates buffered for earlier runs are sent when a later run fails.
+    """
+    import pytest
+    from datetime import datetime, timedelta
+    from cax.task import Task
+    from cax.sweep import Dispatcher
+
+    # Newer, so handled first
+    lone_run_collection.insert_one({'number': 2,
+                                    'start': datetime.now() + timedelta(days=1),
+                                    'data': []})
+
+    class FailingTask(Task):
+        def each_run(self):
+            if self.run_doc['number'] == 1:
+                raise RuntimeError("Lost the disk")
+            self.writes.update({'_id': self.run_doc['_id']},
+                               {'$set': {'status': self.__class__.__name__}})
+
+    class DispatchedTask(FailingTask):
+        pass
+
+    with pytest.raises(RuntimeError):
+        FailingTask().go()
+    assert lone_run_collection.find_one({'number': 2})['status'] == 'FailingTask'
+
+    with pytest.raises(RuntimeError):
+        Dispatcher([DispatchedTask()]).go()
+    assert lone_run_collection.find_one({'number': 2})['status'] == 'DispatchedTask'
+
+
+def test_process_gains(lone_run_collection):
+    """Processing checks for gains without fetching them.
+    """
+    from cax.tasks.process import ProcessBatchQueue
+
+    t = ProcessBatchQueue()
+    assert not any(field.startswith('processor.DEFAULT.gains')
+                   for field in t.projection())
+
+    t.run_doc = lone_run_collection.find_one({}, projection=t.projection())
+    assert not t.has_gains()
+
+    lone_run_collection.update_one({}, {'$set': {'processor.DEFAULT.gains':
+                                                 [1.0] * 248}})
+    t.run_doc = lone_run_collection.find_one({}, projection=t.projection())
+    assert 'gains' not in t.run_doc['processor']['DEFAULT']
+    assert t.has_gains()
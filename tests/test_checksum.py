@@ -0,0 +1,290 @@
+import os
+
+# Import the lone_run_collection fixture, which should be given as an argument to any task.
+from .common import lone_run_collection
+
+
+def make_dataset(path):
+    os.makedirs(os.path.join(path, 'sub'))
+    for i, name in enumerate(['b.zip', 'a.zip', 'sub/c.zip', 'empty']):
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(os.urandom(1000 * i))
+    return path
+
+
+def test_dirhash(tmpdir):
+    """The parallel dirhash gives the same checksum as checksumdir.
+    """
+    import checksumdir
+    from cax.tasks.checksum import dirhash
+
+    location = make_dataset(str(tmpdir.join('dataset')))
+    expected = checksumdir.dirhash(location, 'sha512')
+
+    for workers in (1, 2, 8):
+        assert dirhash(location, 'sha512', workers=workers) == expected
+
+
+def test_compute_digests(tmpdir):
+    """All digests come out of one read, as computed by the old code.
+    """
+    import hashlib
+    from zlib import adler32, crc32
+    from cax.tasks import checksum
+
+    path = str(tmpdir.join('file.zip'))
+    data = os.urandom(300 * 1000) + b'\n' * 10
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    prev = 0
+    for line in open(path, 'rb'):
+        prev = crc32(line, prev)
+
+    for blocksize in (1000, 64 * 1024):
+        digests = checksum.compute_digests(path, checksum.ALGORITHMS, blocksize)
+        assert digests == {'sha512': hashlib.sha512(data).hexdigest(),
+                           'adler32': hex(adler32(data))[2:10].zfill(8).lower(),
+                           'crc32': "%X" % (prev & 0xFFFFFFFF)}
+
+
+def test_checksum_cache(tmpdir, monkeypatch):
+    """Digests are computed together and reused until the file changes.
+    """
+    from cax import config
+    from cax.tasks import checksum
+
+    monkeypatch.setattr(config, 'get_checksum_cache',
+                        lambda: str(tmpdir.join('cache.sqlite')))
+
+    computed = []
+    compute_digests = checksum.compute_digests
+
+    def counting_compute_digests(path, algorithms):
+        computed.append(path)
+        return compute_digests(path, algorithms)
+
+    monkeypatch.setattr(checksum, 'compute_digests', counting_compute_digests)
+
+    path = str(tmpdir.join('file.zip'))
+    with open(path, 'wb') as f:
+        f.write(b'first')
+
+    for algorithm in ('sha512', 'adler32', 'crc32'):
+        value = checksum.file_digest(path, algorithm)
+        assert value == compute_digests(path, (algorithm,))[algorithm]
+    assert len(computed) == 1
+
+    # Rewriting the file invalidates its digests
+    with open(path, 'wb') as f:
+        f.write(b'second, longer')
+    assert checksum.file_digest(path, 'crc32') == \
+        compute_digests(path, ('crc32',))['crc32']
+    assert len(computed) == 2
+
+    # Rewritten with the same size and times, as by a restore: only reading
+    # the file again tells
+    location = str(tmpdir.mkdir('restored'))
+    path = os.path.join(location, 'file.zip')
+    with open(path, 'wb') as f:
+        f.write(b'good')
+    stat = os.stat(path)
+    checksum.file_digest(path)
+    with open(path, 'wb') as f:
+        f.write(b'bad!')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    expected = compute_digests(path, ('sha512',))['sha512']
+    assert checksum.file_digest(path) != expected
+    assert checksum.file_checksums(location, cached=False) == \
+        [['file.zip', expected]]
+    assert checksum.DigestHandle(cached=False).file_digest(path) == expected
+
+
+def test_merkle_root(tmpdir):
+    """Per-file checksums match dirhash and tell which file is bad.
+    """
+    import checksumdir
+    from cax.tasks import checksum
+
+    location = make_dataset(str(tmpdir.join('dataset')))
+    files = checksum.file_checksums(location, workers=2)
+    assert [path for path, value in files] == ['a.zip', 'b.zip', 'empty', 'sub/c.zip']
+    assert checksum.reduce_checksums(files) == \
+        checksumdir.dirhash(location, 'sha512')
+
+    # Corrupt one file
+    with open(os.path.join(location, 'sub', 'c.zip'), 'ab') as f:
+        f.write(b'x')
+    bad = checksum.file_checksums(location)
+
+    assert checksum.merkle_root(bad) != checksum.merkle_root(files)
+    assert checksum.merkle_root(list(reversed(files))) == checksum.merkle_root(files)
+    assert checksum.mismatched_files({'files': bad}, {'files': files}) == ['sub/c.zip']
+    assert checksum.mismatched_files({'files': bad}, {}) is None
+    assert checksum.mismatched_files({'files': bad}, None) is None
+
+
+def test_audit(lone_run_collection, tmpdir, monkeypatch):
+    """Audits re-read files once per period and flag bad data.
+    """
+    from cax import config
+    from cax.tasks.checksum import AddChecksum, AuditChecksums
+
+    def data_doc():
+        return lone_run_collection.find_one({})['data'][0]
+
+    if data_doc()['status'] != 'verifying':
+        return
+    AddChecksum().go()
+
+    settings = {'state_file': str(tmpdir.join('audit.sqlite')),
+                'bytes_per_sweep': 1}
+    monkeypatch.setattr(config, 'get_checksum_audit', lambda: settings)
+
+    AuditChecksums().go()
+    assert 'checksumproblem' not in data_doc()
+
+    # Bit rot, not seen until the file is due again
+    with open(os.path.join(data_doc()['location'], 'example_data.txt'), 'w') as f:
+        f.write("Hi there cax tester?")
+    AuditChecksums().go()
+    assert 'checksumproblem' not in data_doc()
+
+    # Handed over by a single pass while not auditing
+    task = AuditChecksums()
+    monkeypatch.setattr(config, 'get_checksum_audit', lambda: None)
+    task.handle_run(lone_run_collection.find_one({}), None)
+    assert task.candidates == []
+    monkeypatch.setattr(config, 'get_checksum_audit', lambda: settings)
+
+    # Found by a copy of the task, as with workers
+    settings['period_days'] = 0
+    task = AuditChecksums()
+    task.handle_run_in_worker(lone_run_collection.find_one({}))
+    assert task.run_doc is None
+    task.shutdown()
+    assert data_doc()['checksumproblem']
+
+
+def test_master_checksum():
+    """Master checksums are looked up once per run.
+    """
+    from cax.tasks.checksum import CompareChecksums
+
+    def entry(host, checksum, type='raw', pax_version=None, status='transferred'):
+        data_doc = {'host': host, 'type': type, 'status': status,
+                    'checksum': checksum}
+        if pax_version is not None:
+            data_doc['pax_version'] = pax_version
+        return data_doc
+
+    t = CompareChecksums()
+    t.run_doc = {'number': 1,
+                 'data': [entry('midway-login1', 'bad'),
+                          entry('tsm-server', 'good'),
+                          entry('xe1t-datamanager', 'other'),
+                          entry('login', 'p1', 'processed', 'v6.0.0'),
+                          entry('midway-login1', 'p1', 'processed', 'v6.0.0'),
+                          entry('login', 'p2', 'processed', 'v6.1.0'),
+                          entry('tegner-login-1', 'good', status='transferring')]}
+
+    # First master location in the run document wins
+    assert t.get_main_checksum('raw') == 'good'
+    assert t.get_main_checksum('processed', 'v6.0.0') == 'p1'
+    assert t.get_main_checksum('processed', 'v6.1.0') == 'p2'
+    assert t.get_main_checksum('processed', 'v5.0.0') is None
+
+    assert t.check('raw', warn=False) == 1
+    assert t.check('processed', warn=False) == 3
+
+    # A new run document gets a new index
+    t.run_doc = {'number': 2, 'data': [entry('xe1t-datamanager', 'new')]}
+    assert t.get_main_checksum('raw') == 'new'
+    assert t.check('raw', warn=False) == 1
+
+    # No master location to compare files with
+    local = entry('midway-login1', 'local')
+    local['files'] = [['a.zip', 'local']]
+    t.run_doc = {'number': 3, 'data': [local]}
+    assert t.check('raw') == 0
+
+
+def test_checksum_offload(lone_run_collection, monkeypatch):
+    """Large datasets are checksummed by a single batch job.
+    """
+    from cax import config, qsub
+    from cax.tasks.checksum import AddChecksum, ChecksumSingle
+
+    def data_doc():
+        return lone_run_collection.find_one({})['data'][0]
+
+    if data_doc()['status'] != 'verifying':
+        return
+
+    scripts = []
+    queue = []
+    monkeypatch.setattr(config, 'get_checksum_offload', lambda: {'min_bytes': 1})
+    monkeypatch.setattr(config, 'processing_script',
+                        lambda args: '%s: %s' % (args['use'], args['command']))
+    monkeypatch.setattr(qsub, 'submit_job', scripts.append)
+    monkeypatch.setattr(qsub, 'get_queue', lambda host: queue)
+
+    AddChecksum().go()
+    AddChecksum().go()
+    assert len(scripts) == 1
+    assert scripts[0].startswith('checksum_raw: cax-checksum ')
+    assert 'checksum' not in data_doc() and 'checksum_job' in data_doc()
+
+    # Past the grace time, a queued job of another entry of the run does
+    # not count
+    monkeypatch.setattr(AddChecksum, 'offload_grace', 0)
+    queue.append('checksum_raw_1_head')
+    AddChecksum().go()
+    assert len(scripts) == 1
+    queue[:] = ['checksum_processed_v6.0.0_1_head']
+    AddChecksum().go()
+    assert len(scripts) == 2
+
+    # What the job does
+    ChecksumSingle(data_doc()['location']).go()
+    assert data_doc()['status'] == 'transferred'
+    assert 'checksum' in data_doc() and 'checksum_job' not in data_doc()
+
+
+def test_benchmark():
+    """The standalone benchmarks run and give JSON.
+    """
+    import json
+    from cax import benchmark
+
+    results = benchmark.run(n_files=2, file_size=10000, workers=(1, 2),
+                            repeat=1, blocksizes=(4096,))
+    json.dumps(results)
+
+    names = [result['name'] for result in results['paths']]
+    assert 'dirhash sha512' in names and 'ChecksumMethods.get_crc32' in names
+    assert len(results['digests']) == 4
+
+
+def test_digest_handle(tmpdir, monkeypatch):
+    """Files are read once for all digests.
+    """
+    import checksumdir
+    from cax.tasks import checksum
+
+    location = make_dataset(str(tmpdir.join('dataset')))
+
+    reads = []
+    compute_digests = checksum.compute_digests
+    monkeypatch.setattr(checksum, 'compute_digests',
+                        lambda path, algorithms: reads.append(path) or
+                        compute_digests(path, algorithms))
+
+    digests = checksum.DigestHandle()
+    files = checksum.dataset_files(location)
+    for path in files:
+        digests.file_digest(path, 'crc32')
+    assert digests.dirhash(location) == checksumdir.dirhash(location, 'sha512')
+
+    assert sorted(reads) == sorted(files)
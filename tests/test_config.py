@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+from .common import cax_config
+
+
+def test_config_cache(monkeypatch):
+    """cax.json is parsed once, and again only when it changes.
+    """
+    loads = []
+    original_load = cax_config.load
+
+    def counting_load():
+        loads.append(1)
+        return original_load()
+
+    monkeypatch.setattr(cax_config, 'load', counting_load)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'cax.json')
+        with open(filename, 'w') as f:
+            json.dump([{'name': 'midway-login1', 'nstreams': 1}], f)
+
+        monkeypatch.setattr(cax_config, 'CAX_CONFIGURE', filename)
+
+        for i in range(10):
+            assert cax_config.get_config('midway-login1')['nstreams'] == 1
+        assert len(loads) == 1
+
+        with open(filename, 'w') as f:
+            json.dump([{'name': 'midway-login1', 'nstreams': 2},
+                       {'name': 'login'}], f)
+        # Make sure the modification time changes on coarse file systems
+        os.utime(filename, ns=(0, 0))
+
+        assert cax_config.get_config('midway-login1')['nstreams'] == 2
+        assert cax_config.get_config('login') == {'name': 'login'}
+        assert len(loads) == 2
+
+        with pytest.raises(LookupError):
+            cax_config.get_config('unknown-host')
+
+
+def test_mongo_client_registry(monkeypatch):
+    """Clients are shared per URI, but not with a forked child.
+    """
+    import mongomock
+
+    monkeypatch.setattr(cax_config.pymongo, 'MongoClient', mongomock.MongoClient)
+
+    uri = 'mongodb://localhost:27017/run'
+    client = cax_config.mongo_client(uri)
+    assert cax_config.mongo_client(uri) is client
+    assert cax_config.mongo_client('mongodb://otherhost:27017/run') is not client
+
+    monkeypatch.setattr(cax_config.os, 'getpid', lambda: -1)
+    assert cax_config.mongo_client(uri) is not client
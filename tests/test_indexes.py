@@ -0,0 +1,57 @@
+from .common import lone_run_collection
+
+from cax import indexes
+
+
+def test_query_fields():
+    query = {'$and': [{'name': {'$in': ['a']}},
+                      {'data': {'$elemMatch': {'host': 'h',
+                                               'status': {'$ne': 'x'}}}}]}
+    assert indexes.query_fields(query) == {'name', 'data', 'data.host',
+                                           'data.status'}
+
+
+def test_serving_index():
+    served = {'data': {'$elemMatch': {'host': 'h', 'status': 'x'}}}
+    unserved = {'data': {'$elemMatch': {'location': 'l'}}}
+
+    assert indexes.serving_index({'$and': [unserved, served]}) is not None
+    assert indexes.serving_index({'$or': [served, served]}) is not None
+    assert indexes.serving_index({'$or': [served, unserved]}) is None
+    assert indexes.serving_index({'number': 1,
+                                  '$or': [served, unserved]}) is not None
+
+
+def test_query_shapes_covered(lone_run_collection):
+    """Every query cax issues, including task run filters, has an index.
+    """
+    from cax.sweep import Dispatcher
+    from cax.tasks import checksum, clear, corrections, filesystem, process
+
+    purity = lone_run_collection.database['purity']
+    purity.insert_one({'calculation_time': 1, 'function': 't'})
+
+    tasks = [checksum.AddChecksum(), checksum.CompareChecksums(),
+             clear.RetryStalledTransfer(), clear.PurgeProcessed(),
+             corrections.AddElectronLifetime(), filesystem.SetPermission(),
+             process.ProcessBatchQueue()]
+
+    queries = dict(indexes.QUERY_SHAPES)
+    for task in tasks:
+        queries[task.__class__.__name__] = task.run_filter()
+    queries['Dispatcher'] = Dispatcher(tasks).run_filter()
+    purity.drop()
+
+    for name, query in queries.items():
+        assert indexes.serving_index(query) is not None, name
+
+
+def test_create_indexes(lone_run_collection):
+    assert len(indexes.missing_indexes(lone_run_collection)) == len(indexes.INDEXES)
+
+    indexes.create_indexes(lone_run_collection)
+    assert indexes.missing_indexes(lone_run_collection) == []
+    assert indexes.create_indexes(lone_run_collection) == []
+
+    for keys, reason in indexes.INDEXES:
+        lone_run_collection.drop_index(keys)
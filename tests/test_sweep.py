@@ -0,0 +1,108 @@
+import os
+import tempfile
+
+from .common import lone_run_collection, runs_collection
+
+from cax.sweep import ChangeTracker, Dispatcher
+from cax.task import Task
+
+
+class FakeStream:
+    """Stands in for a pymongo change stream"""
+
+    def __init__(self, changes):
+        self.changes = changes
+        self.resume_token = {'_data': 'token%d' % len(changes)}
+
+    def try_next(self):
+        if self.changes:
+            return self.changes.pop(0)
+        return None
+
+    def close(self):
+        pass
+
+
+class FakeCollection:
+    def __init__(self):
+        self.changes = []
+        self.resumed_from = []
+
+    def watch(self, resume_after=None):
+        self.resumed_from.append(resume_after)
+        return FakeStream(self.changes)
+
+
+def test_incremental_sweep():
+    collection = FakeCollection()
+
+    with tempfile.TemporaryDirectory() as dirname:
+        state_file = os.path.join(dirname, 'sweep.json')
+
+        tracker = ChangeTracker(collection, state_file)
+
+        # No high-water mark yet, so everything must be visited
+        assert tracker.start_sweep() is None
+        tracker.end_sweep()
+
+        collection.changes.extend([{'operationType': 'update',
+                                    'documentKey': {'_id': 1}},
+                                   {'operationType': 'update',
+                                    'documentKey': {'_id': 1}}])
+        assert tracker.start_sweep() == {'_id': {'$in': [1]}}
+        tracker.end_sweep()
+
+        # A new daemon resumes from the persisted token
+        tracker = ChangeTracker(collection, state_file)
+        assert tracker.start_sweep() == {'_id': {'$in': []}}
+        assert collection.resumed_from[-1] is not None
+
+        # Safety net
+        tracker.last_full_sweep -= 2 * tracker.full_sweep_interval
+        assert tracker.start_sweep() is None
+
+
+def test_full_sweep_without_change_streams():
+    with tempfile.TemporaryDirectory() as dirname:
+        tracker = ChangeTracker(runs_collection,
+                                os.path.join(dirname, 'sweep.json'))
+        assert tracker.start_sweep() is None
+        assert tracker.start_sweep() is None
+        tracker.end_sweep()
+
+
+def test_dispatcher(lone_run_collection):
+    """Tasks see the run in order, and the writes of the tasks before them.
+    """
+    seen = []
+
+    class Tagger(Task):
+        def each_run(self):
+            seen.append(('Tagger', self.run_doc.get('tags')))
+            self.collection.update_one({'_id': self.run_doc['_id']},
+                                       {'$set': {'tags': [{'name': 'seen'}]}})
+
+    class Reader(Task):
+        def each_run(self):
+            seen.append(('Reader', self.run_doc.get('tags')))
+
+    Dispatcher([Reader(), Tagger(), Reader()]).go()
+    assert seen == [('Reader', None),
+                    ('Tagger', None),
+                    ('Reader', [{'name': 'seen'}])]
+
+
+def test_dispatcher_flush(lone_run_collection):
+    """Buffered updates are sent once per run, after all tasks had it.
+    """
+    flushed = []
+
+    class Buffering(Task):
+        def each_run(self):
+            flushed.append(lone_run_collection.find_one({}).get('count', 0))
+            self.writes.update({'_id': self.run_doc['_id']},
+                               {'$inc': {'count': 1}})
+
+    Dispatcher([Buffering(), Buffering()]).go()
+    assert flushed == [0, 0]
+    assert lone_run_collection.find_one({})['count'] == 2
@@ -0,0 +1,371 @@
+import os
+import threading
+import time
+
+import pytest
+
+# Import the lone_run_collection fixture, which should be given as an argument to any task.
+from .common import lone_run_collection
+
+
+def test_scheduler_priority():
+    """With a single slot, transfers run in order of priority.
+    """
+    from cax.transfer import TransferScheduler
+
+    order = []
+    scheduler = TransferScheduler()
+    for priority, name in [(2, 'c'), (0, 'a'), (1, 'b'), (0, 'a2')]:
+        scheduler.add(priority, 'here', 'there', order.append, name)
+    scheduler.run()
+
+    assert order == ['a', 'a2', 'b', 'c']
+
+
+def test_scheduler_caps():
+    """Per destination and per link limits hold, other transfers go ahead.
+    """
+    from cax.transfer import TransferScheduler
+
+    lock = threading.Lock()
+    running = {}
+    most = {}
+
+    def transfer(source, destination):
+        with lock:
+            for key in (destination, (source, destination), 'total'):
+                running[key] = running.get(key, 0) + 1
+                most[key] = max(most.get(key, 0), running[key])
+        time.sleep(0.02)
+        with lock:
+            for key in (destination, (source, destination), 'total'):
+                running[key] -= 1
+
+    scheduler = TransferScheduler(max_transfers=4, per_destination=2,
+                                  per_link=1)
+    for i in range(4):
+        for source in ('here', 'elsewhere'):
+            for destination in ('tape', 'grid'):
+                scheduler.add(i, source, destination, transfer, source,
+                              destination)
+    scheduler.run()
+
+    assert most['total'] == 4
+    assert most['tape'] == most['grid'] == 2
+    assert all(most[(source, destination)] == 1
+               for source in ('here', 'elsewhere')
+               for destination in ('tape', 'grid'))
+    assert all(count == 0 for count in running.values())
+
+
+def test_scheduler_failure():
+    """A failed transfer does not stop the others.
+    """
+    from cax.transfer import TransferScheduler
+
+    done = []
+
+    def fail():
+        raise RuntimeError("Connection lost")
+
+    scheduler = TransferScheduler(max_transfers=2)
+    scheduler.add(0, 'here', 'tape', fail)
+    scheduler.add(1, 'here', 'tape', done.append, 'grid')
+    scheduler.run()
+
+    assert done == ['grid']
+
+
+def test_ssh_transport_pool(monkeypatch):
+    """Connections are reused per server, user and compression, and
+    replaced once dead.
+    """
+    from cax import transfer
+
+    connects = []
+
+    class Transport:
+        active = True
+
+        def is_active(self):
+            return self.active
+
+        def set_keepalive(self, interval):
+            pass
+
+    class SSHClient:
+        def load_system_host_keys(self):
+            pass
+
+        def connect(self, server, **kwargs):
+            connects.append((server, kwargs['compress']))
+            self.transport = Transport()
+
+        def get_transport(self):
+            return self.transport
+
+        def close(self):
+            self.transport.active = False
+
+    monkeypatch.setattr(transfer.paramiko, 'SSHClient', SSHClient)
+    monkeypatch.setattr(transfer, '_SSH_CLIENTS', {})
+    monkeypatch.setattr(transfer, '_SSH_PID', -1)
+
+    transport = transfer.ssh_transport('tegner', 'xe1ttransfer')
+    assert transfer.ssh_transport('tegner', 'xe1ttransfer') is transport
+    assert transfer.ssh_transport('tegner', 'xe1ttransfer',
+                                  compress=True) is not transport
+    assert len(connects) == 2
+
+    transport.active = False
+    assert transfer.ssh_transport('tegner', 'xe1ttransfer') is not transport
+    assert connects == [('tegner', False), ('tegner', True),
+                        ('tegner', False)]
+
+    transfer.close_ssh_transports()
+    assert not transfer._SSH_CLIENTS
+
+
+class LocalSFTP:
+    """Stands in for an SFTP session, on the local file system"""
+
+    class File:
+        def __init__(self, f):
+            self.f = f
+
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.f.close()
+
+        def set_pipelined(self, pipelined):
+            pass
+
+        def prefetch(self, size):
+            pass
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def open(self, path, mode):
+        if self.failures.get(os.path.basename(path)):
+            self.failures[os.path.basename(path)] -= 1
+            raise IOError("Channel closed")
+        return self.File(open(path, mode))
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def listdir_attr(self, path):
+        entries = []
+        for filename in os.listdir(path):
+            entry = os.stat(os.path.join(path, filename))
+            entries.append(type('Entry', (), {'filename': filename,
+                                              'st_mode': entry.st_mode}))
+        return entries
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def close(self):
+        pass
+
+
+def test_sftp_copy(tmpdir, monkeypatch):
+    """Files of a dataset are copied in parallel, resumed and retried.
+    """
+    from cax import transfer
+
+    monkeypatch.setattr(transfer.time, 'sleep', lambda seconds: None)
+
+    source = str(tmpdir.join('source'))
+    os.makedirs(os.path.join(source, 'sub'))
+    contents = {}
+    for i, name in enumerate(['a.zip', 'b.zip', 'sub/c.zip', 'empty']):
+        contents[name] = os.urandom(3000 * i)
+        with open(os.path.join(source, name), 'wb') as f:
+            f.write(contents[name])
+
+    # Left over from an earlier attempt
+    uploaded = str(tmpdir.join('uploaded'))
+    os.makedirs(uploaded)
+    with open(os.path.join(uploaded, 'b.zip'), 'wb') as f:
+        f.write(contents['b.zip'][:1000])
+
+    failures = {'c.zip': 2}
+    progress = []
+    copier = transfer.SFTPCopy('tegner', 'xe1ttransfer', workers=3,
+                               progress=lambda *args: progress.append(args))
+    copier.open_sftp = lambda slot=0: LocalSFTP(failures)
+
+    copier.upload(source, uploaded)
+    downloaded = str(tmpdir.join('downloaded'))
+    copier.download(uploaded, downloaded)
+
+    for name, content in contents.items():
+        for location in (uploaded, downloaded):
+            with open(os.path.join(location, name), 'rb') as f:
+                assert f.read() == content
+
+    assert ('b.zip', 3000, 3000) in progress
+    assert failures == {'c.zip': 0}
+
+    # Out of retries
+    failures['a.zip'] = 3
+    os.remove(os.path.join(downloaded, 'a.zip'))
+    with pytest.raises(IOError):
+        copier.download(uploaded, downloaded)
+
+    # A single file
+    copier.upload(os.path.join(source, 'sub', 'c.zip'),
+                  str(tmpdir.join('single', 'c.root')))
+    with open(str(tmpdir.join('single', 'c.root')), 'rb') as f:
+        assert f.read() == contents['sub/c.zip']
+
+
+def test_copy_dataset_resume(tmpdir, monkeypatch):
+    """Only files missing from the manifest are copied, downloads are
+    checked against the source checksums.  Sources not checksummed yet are
+    listed by size.
+    """
+    import shutil
+    from cax.tasks import checksum, data_mover
+    from cax.transfer import Manifest
+
+    source = str(tmpdir.join('source'))
+    os.makedirs(source)
+    for name in ('a.zip', 'b.zip', 'c.zip'):
+        with open(os.path.join(source, name), 'wb') as f:
+            f.write(os.urandom(1000))
+    files = checksum.file_checksums(source)
+    digests = dict(files)
+
+    copied = []
+
+    def copy(datum_original, datum_destination, method, option_type,
+             data_type):
+        copied.append(os.path.basename(datum_original['location']))
+        shutil.copy(datum_original['location'], datum_destination['location'])
+
+    task = data_mover.CopyPush()
+    monkeypatch.setattr(task, 'copy', copy)
+
+    # Uploaded a.zip, b.zip was being replaced
+    destination = str(tmpdir.join('destination'))
+    os.makedirs(destination)
+    manifest = Manifest(None, 1, {}, [['a.zip', digests['a.zip']],
+                                      ['b.zip', 'outdated']])
+    task.copy_dataset({'location': source, 'files': files},
+                      {'location': destination}, 'gfal-copy', 'upload', 'raw',
+                      manifest)
+    assert copied == ['b.zip', 'c.zip']
+    assert all(manifest.complete(path, digest) for path, digest in files)
+
+    # Download, with c.zip not matching the source
+    copied.clear()
+    downloaded = str(tmpdir.join('downloaded'))
+    files[2] = ['c.zip', 'corrupt']
+    manifest = Manifest(None, 1, {}, [['a.zip', digests['a.zip']]])
+    with pytest.raises(IOError):
+        task.copy_dataset({'location': source, 'files': files},
+                          {'location': downloaded}, 'gfal-copy', 'download',
+                          'raw', manifest)
+    assert copied == ['a.zip', 'b.zip', 'c.zip']
+    assert sorted(os.listdir(downloaded)) == ['a.zip', 'b.zip']
+    assert manifest.complete('b.zip', digests['b.zip'])
+    assert not manifest.complete('c.zip', 'corrupt')
+
+    # Not checksummed yet: files are known by their size, not hashed
+    copied.clear()
+    monkeypatch.setattr(checksum, 'compute_digests', None)
+    manifest = Manifest(None, 1, {}, [['a.zip', 'size:1000']])
+    task.copy_dataset({'location': source},
+                      {'location': str(tmpdir.mkdir('legacy'))}, 'gfal-copy',
+                      'upload', 'raw', manifest)
+    assert copied == ['b.zip', 'c.zip']
+    assert manifest.complete('c.zip', 'size:1000')
+
+
+def test_retry_resumes(lone_run_collection):
+    """A stalled transfer with a manifest is left to resume, not purged.
+    """
+    import datetime
+    from cax.tasks import clear
+
+    lone_run_collection.update_one({'number': 1},
+                                   {'$set': {'data.0.creation_time':
+                                             datetime.datetime.utcnow(),
+                                             'data.0.manifest':
+                                             [['example_data.txt', 'x']]}})
+    status = lone_run_collection.find_one()['data'][0]['status']
+
+    clear.RetryStalledTransfer().go()
+    data = lone_run_collection.find_one()['data']
+    assert len(data) == 1
+    if status == 'error':
+        assert data[0]['status'] == 'resume'
+    else:
+        assert data[0]['status'] == status
+
+    # Waiting to be resumed is not an error
+    clear.RetryStalledTransfer().go()
+    assert lone_run_collection.find_one()['data'] == data
+
+
+def test_transfer_process():
+    """Output is handled line by line as it comes, and only its end kept.
+    """
+    import subprocess
+    from cax.transfer import TransferProcess
+
+    lines = []
+    script = 'for i in $(seq 1 500); do printf "a.zip %d\\r 45%% 1.5MB/s\\n" $i; done'
+    process = TransferProcess(['sh', '-c', script], lines.append,
+                              max_lines=10)
+    output = process.run()
+
+    assert len(lines) == 1000
+    assert lines[:2] == ['a.zip 1', ' 45% 1.5MB/s']
+    assert output.splitlines() == lines[-10:]
+    assert (process.percent, process.rate) == ('45', '1.5MB/s')
+    assert not process.errors
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        TransferProcess(['sh', '-c', 'echo "error: no such file"; exit 2']).run()
+    assert e.value.returncode == 2
+    assert e.value.output == 'error: no such file'
+
+
+def test_transfer_process_stall():
+    """A tool printing nothing for too long is killed.
+    """
+    import subprocess
+    from cax.transfer import TransferProcess
+
+    start = time.time()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        TransferProcess(['sh', '-c', 'echo started; sleep 30'],
+                        stall_timeout=0.5).run()
+    assert e.value.output == 'started'
+    assert time.time() - start < 10
+
+
+def test_transfer_process_silent(monkeypatch):
+    """Tools printing nothing while they copy, as gfal-copy, are only
+    killed if asked for.
+    """
+    import subprocess
+    from cax import config, transfer
+
+    monkeypatch.setattr(transfer, 'STALL_TIMEOUT', 0.5)
+    monkeypatch.setattr(config, 'get_stall_timeout', lambda: None)
+
+    command = ['sh', '-c', 'sleep 2; echo "Copying 1 files"']
+    assert transfer.TransferProcess(command).run() == 'Copying 1 files'
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        transfer.TransferProcess(command, stall_timeout=None).run()